@@ -22,5 +22,7 @@ A small package to help in parsing simple text messages to come up with ordered
       ],
       entry_points="""
       # -*- Entry points: -*-
+      [console_scripts]
+      smsform-batch = simplesmsforms.smsform_cli:main
       """,
       )
@@ -1,13 +1,45 @@
-import re
-import itertools
-from smsform_exceptions import SMSFieldException, MissingRequiredFieldException
+import collections
+
+from smsform_exceptions import (SMSFieldException, MissingRequiredFieldException,
+                                MessageTooLongException, MessageTimeoutException)
+from smsform_binding import (FieldBinder, to_string, tokenize, find_ambiguous_prefixes,
+                             warn_ambiguous)
+from smsform_fields import GenericSMSField
+from smsform_plan import FormPlan
+from smsform_result import ParsedMessage, LazyValue
+from smsform_instrumentation import timer
+import smsform_batch
 # SMS Form
 
-def to_string(item):
-    if isinstance(item, list):
-        return ",".join(item)
-    if isinstance(item, str):
-        return item
+VALIDATION_MODES = ("full", "fail_fast", "errors_only", "lazy")
+
+
+class SMSFormMetaclass(type):
+
+    """Collects the fields declared on a form class, including inherited
+    ones, in the order they were created, and warns about ambiguous
+    prefixes among them. The form's plan is compiled the first time it is
+    needed, or loaded with smsform_plan.load_plans."""
+
+    def __new__(mcs, name, bases, attrs):
+        declared = [(attribute_name, value) for attribute_name, value in attrs.items()
+                    if isinstance(value, GenericSMSField)]
+        declared.sort(key=lambda declaration: declaration[1].creation_counter)
+        for attribute_name, field in declared:
+            if field.name is None:
+                field.name = attribute_name
+
+        form_class = super(SMSFormMetaclass, mcs).__new__(mcs, name, bases, attrs)
+
+        fields = collections.OrderedDict()
+        for base in reversed(form_class.__mro__[1:]):
+            fields.update(base.__dict__.get("declared_fields", ()))
+        fields.update(declared)
+        form_class.declared_fields = tuple(fields.items())
+        if form_class.uses_declared_fields() and form_class.binding != "positional":
+            warn_ambiguous(name, find_ambiguous_prefixes(fields.values()))
+        return form_class
+
 
 class SMSForm(object):
 
@@ -26,74 +58,149 @@ class SMSForm(object):
                     ward = PrefixField(prefixes=wd)
 
                     """
+    __metaclass__ = SMSFormMetaclass
+
     keyword = ""
+    aliases = ()
+    # How message tokens are bound to fields: "prefix", "positional" or
+    # "hybrid", see FieldBinder
+    binding = "prefix"
+    # The token that marks a skipped field in positional binding
+    blank_field = None
+    # An Instrumentation to record stage timings and counters to
+    instrumentation = None
+    # A ResultCache to answer repeated messages from
+    result_cache = None
+    # A SessionStore that lets senders complete an invalid message with
+    # follow up messages
+    session_store = None
+    # Longer messages are rejected without being bound, 1600 characters is
+    # what most gateways will concatenate
+    max_message_length = 1600
+    # Seconds a message may take to validate, fields are no longer validated
+    # once it is spent. None for no budget
+    time_budget = None
 
     def parse_text(self, text=None):
         if not text:
             text = self.original_text
         """parses the passed in text to return a nice list of the passed in
         fields WITHOUT the form keyword"""
-        fields = text.split(" ")
-        return [field.strip() for field in fields[1:] if field != ""]
+        return tokenize(text)[1:]
 
     def bind_fields(self, text_string):
         """Binds the passed in text fields with the form fields and returns
-        a dict that looks like:
-        {field_name: ("prefix", "value")}
+        a tuple that looks like:
+        ((field, ("prefix", "value")), ...)
         """
+        return self.get_binder().bind_message(text_string)
 
-        """
-        bound_fields = itertools.izip_longest(
-            self.get_fields(),
-            text_fields,
-            fillvalue=" ")
-        """
-        bound_fields = ()
-        for expected_field in self.get_fields():
-            for prefix_regex in expected_field.get_field_regex():
-                compiled_regex = re.compile(prefix_regex["regex"], re.IGNORECASE)
-                match = compiled_regex.findall(text_string)
-                if match:
-                    bound_field = (
-                        expected_field,
-                        (prefix_regex["prefix"], to_string(match))
-                        )
-                    bound_fields += (bound_field, )
-                    expected_field.accepted_prefix = prefix_regex["prefix"]
-                    break
-        return bound_fields
+    def get_binder(self):
+        """Returns the FieldBinder of this form's plan"""
+        return self.get_plan().binder
+
+    def get_plan(self):
+        """Returns the FormPlan this form processes messages with, it is
+        compiled once per form class"""
+        plan = type(self).__dict__.get("_plan")
+        if plan is None:
+            plan = type(self).compile_plan(self.get_fields())
+        return plan
+
+    @classmethod
+    def compile_plan(cls, fields):
+        """Compiles fields into the form's plan. Ambiguous prefixes of forms
+        that override get_fields are reported here, those of declared fields
+        are reported when the form class is created"""
+        attribute_names = {}
+        for klass in reversed(cls.__mro__):
+            for attribute_name, value in klass.__dict__.items():
+                if isinstance(value, GenericSMSField):
+                    attribute_names[id(value)] = attribute_name
+        fields = list(fields)
+        binder = FieldBinder(fields, cls.binding, cls.blank_field)
+        for field in fields:
+            attribute_name = attribute_names.get(id(field))
+            if attribute_name is not None and getattr(cls, attribute_name) is field:
+                field.set_owner(cls, attribute_name)
+        plan = FormPlan(cls, fields, [attribute_names.get(id(field)) for field in fields], binder)
+        if not cls.uses_declared_fields():
+            plan.binder.warn_ambiguous(cls.__name__)
+        cls._plan = plan
+        return plan
 
     def get_fields(self):
-        """Must return a list of the fields to be included in the form"""
-        raise NotImplementedError
+        """Returns the list of the fields to be included in the form, by
+        default the fields declared on the form in the order they were
+        created"""
+        return [field for attribute_name, field in self.declared_fields]
+    get_fields.declarative = True
+
+    @classmethod
+    def uses_declared_fields(cls):
+        """True unless the form overrides get_fields"""
+        return getattr(cls.get_fields, "declarative", False)
 
-    def validate_form(self, bound_fields):
+    def validate_form(self, bound_fields, mode="full", deadline=None):
         """Responsible for converting fields to valid python objects and doing
-        any field based validation
+        any field based validation. The mode decides how much work is done:
+        "full" converts and validates every field, "fail_fast" stops at the
+        first error, "errors_only" validates every field with check_field,
+        which skips conversion where the field allows it, and returns no
+        python objects and "lazy" only checks required fields are present and
+        returns LazyValues that are converted when they are first read. As
+        lazy values are not validated yet, passed_validation is None rather
+        than True for a lazy message with every required field.
+        Once the timer passes deadline the remaining fields are not
+        validated and a MessageTimeoutException is added to the errors.
         TODO: Terrible doing validation and conversion to python in this method"""
+        if mode not in VALIDATION_MODES:
+            raise ValueError("Unknown validation mode {mode!r}, expected one of {modes}".format(
+                mode=mode, modes=", ".join(VALIDATION_MODES)))
         passed_validation = True
         errors = []
-        python_fields = ()
+        python_fields = []
 
-        bound_fields_dict = self.bound_fields_to_bound_dict(bound_fields)
-        for field in self.get_fields():
-            field_name = field.name
+        bound_fields_dict = dict(bound_fields)
+        instrumentation = self.instrumentation
+        for field in self.get_plan().fields:
+            if deadline is not None and timer() > deadline:
+                errors.append(MessageTimeoutException(self.time_budget))
+                passed_validation = False
+                break
             try:
-                value = bound_fields_dict[field]['value']
-                prefix = bound_fields_dict[field]['prefix']
-                valid_obj = field.process_field(value, prefix)
+                prefix, value = bound_fields_dict[field]
+            except KeyError:
+                if not field.required:
+                    continue
+                errors.append(MissingRequiredFieldException(field.name))
+                passed_validation = False
+                if mode == "fail_fast":
+                    break
+                continue
+
+            if mode == "lazy":
+                python_fields.append((field, (prefix, LazyValue(field, value, prefix))))
+                continue
+            try:
+                if mode == "errors_only" and instrumentation is None:
+                    field.check_field(value, prefix)
+                    continue
+                if instrumentation is None:
+                    valid_obj = field.process_field(value, prefix)
+                else:
+                    valid_obj = instrumentation.time_field(self, field, value, prefix)
             except SMSFieldException, e:
                 errors.append(e)
                 passed_validation = False
-            except KeyError, e:
-                if field.required:
-                    errors.append(MissingRequiredFieldException(field_name))
-                    passed_validation = False
-                else:
-                    pass
+                if mode == "fail_fast":
+                    break
             else:
-                python_fields += ((field, (prefix, valid_obj)),)
-        return passed_validation, python_fields, errors
+                if mode != "errors_only":
+                    python_fields.append((field, (prefix, valid_obj)))
+        if mode == "lazy" and passed_validation:
+            passed_validation = None
+        return passed_validation, tuple(python_fields), errors
 
     def bound_fields_to_bound_dict(self, bound_fields):
         bound_dict = {}
@@ -103,16 +210,83 @@ class SMSForm(object):
             bound_dict[field_name] = {"value":value, "prefix":prefix}
         return bound_dict
 
-    def process_form(self, original_text):
+    def process_form(self, original_text, sender=None, mode="full"):
+        """Binds and validates the text and returns a ParsedMessage, which
+        can still be unpacked as (passed_validation, python_fields, errors).
+        When the sender is given a message that was already processed is
+        answered from the form's result_cache and a follow up message
+        continues the sender's session in the form's session_store. mode is
+        passed on to validate_form, only "full" results are cached or kept in
+        sessions. Follow ups are never answered from the cache, their result
+        depends on the session as well as the text.
+
+        Messages longer than max_message_length are rejected with a
+        MessageTooLongException before anything else is done."""
+        if self.max_message_length is not None and len(original_text) > self.max_message_length:
+            return self.make_result(False, (), [MessageTooLongException(self.max_message_length)])
+        if sender is not None and mode == "full":
+            if self.result_cache is not None and not (
+                    self.session_store is not None and
+                    self.session_store.continues(self, sender, original_text)):
+                return self.result_cache.process(
+                    self, sender, original_text, lambda text: self.process_sent(text, sender))
+            return self.process_sent(original_text, sender)
+        return self.process_text(original_text, mode)
+
+    def process_sent(self, original_text, sender):
+        if self.session_store is not None:
+            return self.session_store.process(self, sender, original_text)
+        return self.process_text(original_text)
+
+    def process_text(self, original_text, mode="full"):
+        if self.instrumentation is not None:
+            return self.process_form_instrumented(original_text, mode)
+
+        deadline = self.get_deadline()
+        bound_fields = self.bind_fields(original_text)
+        return self.make_result(*self.validate_form(bound_fields, mode, deadline))
+
+    def get_deadline(self):
+        """Returns the timer value the time_budget of a message starting now
+        runs out at, None when the form has no time_budget"""
+        if self.time_budget is None:
+            return None
+        return timer() + self.time_budget
+
+    def process_form_instrumented(self, original_text, mode="full"):
+        start = timer()
+        deadline = self.get_deadline()
         bound_fields = self.bind_fields(original_text)
-        passed_validation, python_fields, errors = self.validate_form(bound_fields)
-
-        #The bound fields in here have a structure that binds the actual field
-        #functions to the field and prefix. We transform that to (field name, (prefix, text))
-        transformed_bound_fields = ()
-        for bound_field in python_fields:
-            prefix_with_text = (bound_field[1][0], bound_field[1][1])
-            transformed_bound_fields += ((
-                (bound_field[0].name, prefix_with_text)
-                ,))
-        return passed_validation, transformed_bound_fields, errors
+        bound = timer()
+        passed_validation, python_fields, errors = self.validate_form(bound_fields, mode, deadline)
+        validated = timer()
+        result = self.make_result(passed_validation, python_fields, errors)
+        self.instrumentation.record_message(self, original_text, {
+            "bind_fields": bound - start,
+            "validate_form": validated - bound,
+        }, result)
+        return result
+
+    def make_result(self, passed_validation, python_fields, errors):
+        #The python fields bind the actual field objects to the prefix and
+        #value, the result only keeps the field names
+        names = []
+        prefixes = []
+        values = []
+        for field, (prefix, value) in python_fields:
+            names.append(field.name)
+            prefixes.append(prefix)
+            values.append(value)
+        return ParsedMessage(passed_validation, names, prefixes, values, errors)
+
+    def process_many(self, texts, workers=None, chunksize=100, ordered=True):
+        """Processes an iterable of texts and yields (index, result) pairs,
+        see smsform_batch.process_many"""
+        return smsform_batch.process_many(
+            self, texts, workers=workers, chunksize=chunksize, ordered=ordered)
+
+    def process_many_threaded(self, texts, workers=4, chunksize=100, ordered=True):
+        """Processes an iterable of texts in a thread pool and yields (index,
+        result) pairs, see smsform_batch.process_many_threaded"""
+        return smsform_batch.process_many_threaded(
+            self, texts, workers=workers, chunksize=chunksize, ordered=ordered)
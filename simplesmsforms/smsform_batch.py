@@ -0,0 +1,140 @@
+import functools
+import itertools
+import multiprocessing
+import multiprocessing.pool
+import sys
+import threading
+
+# BATCH PROCESSING
+
+# The form each pool worker processes messages with, it is built once when the
+# worker starts so chunks only carry (index, text) pairs
+_worker_form = None
+
+# Form settings that hold locks, connections or counters, they belong to the
+# process that set them and can not be handed to process pool workers
+PROCESS_LOCAL_SETTINGS = ("instrumentation", "result_cache", "session_store")
+
+
+def init_worker(plan, settings):
+    """Installs the plan the parent process compiled, so workers do not
+    compile the form again, and applies the settings of the parent's form
+    instance"""
+    global _worker_form
+    plan.install()
+    _worker_form = plan.form_class()
+    _worker_form.__dict__.update(settings)
+
+
+def get_worker_settings(form):
+    """Returns the attributes set on the form instance, which workers build
+    their own form with. Process local settings, set on the instance or on
+    the form class, raise a ValueError instead of being silently left out"""
+    settings = dict(vars(form))
+    local_settings = [name for name in PROCESS_LOCAL_SETTINGS
+                      if getattr(form, name, None) is not None]
+    if local_settings:
+        raise ValueError("{settings} set on the form can not be used by process pool "
+                         "workers, use process_many_threaded instead".format(
+                             settings=", ".join(local_settings)))
+    return settings
+
+
+def process_chunk(chunk, form=None):
+    if form is None:
+        form = _worker_form
+    return [(index, form.process_form(text)) for index, text in chunk]
+
+
+def chunked(iterable, chunksize):
+    """Splits an iterable into lists of at most chunksize items"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
+def process_many(form, texts, workers=None, chunksize=100, ordered=True):
+    """Processes an iterable of texts with form and yields (index, result)
+    pairs where index is the position of the text in the input.
+
+    With more than one worker the texts are sent in chunks to a process pool,
+    at most a few chunks per worker are in flight at a time so memory stays
+    flat however long the input is. Passing ordered=False yields results as
+    soon as their chunk is done instead of in input order.
+
+    Workers build their form from the form's plan and the attributes set on
+    the form instance. A form with instrumentation, a result_cache or a
+    session_store set on the instance raises a ValueError, those only work
+    in the process that owns them."""
+    if not workers or workers <= 1:
+        return process_inline(form, texts)
+    make_pool = functools.partial(
+        multiprocessing.Pool, workers, initializer=init_worker,
+        initargs=(form.get_plan(), get_worker_settings(form)))
+    return process_in_pool(make_pool, process_chunk, texts, workers, chunksize, ordered)
+
+
+def process_many_threaded(form, texts, workers=4, chunksize=100, ordered=True):
+    """Same as process_many but the chunks are processed by a pool of threads
+    sharing form, which avoids pickling texts and results between processes.
+
+    Forms are safe to share between threads: fields are frozen once a form
+    compiles them and no per message state is stored on the form or its
+    fields. On a standard CPython build the GIL still runs one thread at a
+    time, threads pay off on free threaded builds or when a validator waits
+    on I/O."""
+    if not workers or workers <= 1:
+        return process_inline(form, texts)
+    form.get_binder()
+    make_pool = functools.partial(multiprocessing.pool.ThreadPool, workers)
+    return process_in_pool(
+        make_pool, functools.partial(process_chunk, form=form), texts, workers, chunksize, ordered)
+
+
+def process_inline(form, texts):
+    for index, text in enumerate(texts):
+        yield index, form.process_form(text)
+
+
+def process_in_pool(make_pool, process, texts, workers, chunksize, ordered):
+    # The pool takes chunks from feed_chunks as fast as it can, a slot has to
+    # be free first so at most workers * 4 chunks are queued or in flight. A
+    # slot is freed each time a chunk's results are taken
+    slots = threading.Semaphore(workers * 4)
+    stopped = threading.Event()
+    input_errors = []
+
+    def feed_chunks():
+        try:
+            for chunk in chunked(enumerate(texts), chunksize):
+                slots.acquire()
+                if stopped.is_set():
+                    return
+                yield chunk
+        except Exception:
+            # The pool would swallow errors raised while reading the input
+            input_errors.append(sys.exc_info())
+
+    pool = make_pool()
+    try:
+        if ordered:
+            chunk_results = pool.imap(process, feed_chunks())
+        else:
+            chunk_results = pool.imap_unordered(process, feed_chunks())
+        for results in chunk_results:
+            slots.release()
+            for result in results:
+                yield result
+        if input_errors:
+            error_type, error, traceback = input_errors[0]
+            raise error_type, error, traceback
+        pool.close()
+    finally:
+        stopped.set()
+        # Wakes feed_chunks if it is waiting for a slot
+        slots.release()
+        pool.terminate()
+        pool.join()
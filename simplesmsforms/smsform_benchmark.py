@@ -0,0 +1,185 @@
+import argparse
+import json
+import random
+import sys
+import timeit
+import warnings
+
+from smsform import SMSForm
+from smsform_fields import PrefixField, SingleChoiceField, DateField
+
+# BENCHMARKS
+
+STAGES = ("parse_text", "bind_fields", "validate_form", "process_form")
+LATENCY_PERCENTILES = (50, 90, 99)
+
+WORDS = ["Andre", "Lesa", "Lusaka", "Ndola", "Kitwe", "Chipata", "Mongu",
+         "Kasama", "Solwezi", "Banda", "Phiri", "Mwale", "Tembo", "Zulu"]
+MONTHS = ["jan", "feb", "mar", "apr", "may", "jun",
+          "jul", "aug", "sep", "oct", "nov", "dec"]
+
+
+def build_form(field_count=5, choice_count=50, prefix_collisions=False):
+    """Builds a form class with field_count prefix fields, a choice field with
+    choice_count choices and an optional date field. With prefix_collisions
+    the prefixes start with one another the way "l", "ln" and "loc" do."""
+    attrs = {"keyword": "BENCH"}
+    for number in range(field_count):
+        if prefix_collisions:
+            prefix = "f" + "x" * number
+        else:
+            prefix = "f{number}x".format(number=number)
+        attrs["field_{number}".format(number=number)] = PrefixField(prefixes=[prefix])
+    choices = ["choice{number}".format(number=number) for number in range(choice_count)]
+    attrs["choice"] = SingleChoiceField(choices=choices)
+    attrs["date"] = DateField(prefixes=["dt"], required=False)
+    return type("BenchmarkForm", (SMSForm,), attrs)
+
+
+def generate_corpus(form, count, seed=0, invalid_rate=0.1, bad_date_rate=0.1,
+                    noisy_spacing_rate=0.2):
+    """Returns count messages for a form built by build_form. A share of the
+    messages leave out a required field, carry a date that can not be parsed
+    or are padded with extra spaces."""
+    randomizer = random.Random(seed)
+    fields = form().get_fields()
+    messages = []
+    for _ in range(count):
+        tokens = [form.keyword]
+        for field in fields:
+            if isinstance(field, SingleChoiceField):
+                tokens.append(randomizer.choice(field.choices))
+            elif isinstance(field, DateField):
+                if randomizer.random() < bad_date_rate:
+                    tokens.append("{day}xx{year}".format(
+                        day=randomizer.randint(1, 40), year=randomizer.randint(0, 99)))
+                else:
+                    tokens.append("{day}{month}{year:02d}".format(
+                        day=randomizer.randint(1, 28), month=randomizer.choice(MONTHS),
+                        year=randomizer.randint(0, 99)))
+            else:
+                tokens.append(field.prefixes[0] + randomizer.choice(WORDS))
+        if randomizer.random() < invalid_rate:
+            tokens.pop(randomizer.randint(1, len(tokens) - 2))
+        separator = " "
+        if randomizer.random() < noisy_spacing_rate:
+            separator = " " * randomizer.randint(2, 4)
+        messages.append(separator.join(tokens))
+    return messages
+
+
+def percentile(sorted_values, percent):
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def summarize(latencies):
+    """Returns messages per second and latency percentiles in microseconds for
+    a list of per message latencies in seconds"""
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    summary = {
+        "messages": len(latencies),
+        "messages_per_second": len(latencies) / total if total else 0.0,
+        "max_us": latencies[-1] * 1e6,
+    }
+    for percent in LATENCY_PERCENTILES:
+        summary["p{percent}_us".format(percent=percent)] = percentile(latencies, percent) * 1e6
+    return summary
+
+
+def time_stage(stage, inputs):
+    timer = timeit.default_timer
+    latencies = []
+    for stage_input in inputs:
+        start = timer()
+        stage(stage_input)
+        latencies.append(timer() - start)
+    return latencies
+
+
+def run_benchmark(form, messages):
+    """Times each stage of the form over messages and returns a dict of
+    stage name to its summary"""
+    bound_fields = [form.bind_fields(message) for message in messages]
+    stages = {
+        "parse_text": (form.parse_text, messages),
+        "bind_fields": (form.bind_fields, messages),
+        "validate_form": (form.validate_form, bound_fields),
+        "process_form": (form.process_form, messages),
+    }
+    return dict((name, summarize(time_stage(*stages[name]))) for name in STAGES)
+
+
+def compare(baseline, current, threshold=0.1):
+    """Returns a list of (benchmark, stage, baseline rate, current rate) for
+    every stage whose throughput dropped by more than threshold"""
+    regressions = []
+    for benchmark, stages in sorted(current.items()):
+        for stage, summary in sorted(stages.items()):
+            try:
+                baseline_rate = baseline[benchmark][stage]["messages_per_second"]
+            except KeyError:
+                continue
+            current_rate = summary["messages_per_second"]
+            if current_rate < baseline_rate * (1 - threshold):
+                regressions.append((benchmark, stage, baseline_rate, current_rate))
+    return regressions
+
+
+def run_suite(messages=2000, seed=0):
+    """Runs the standard set of benchmark forms and returns their results
+    keyed by benchmark name"""
+    suites = {
+        "small_form": dict(field_count=3, choice_count=5),
+        "wide_form": dict(field_count=30, choice_count=5),
+        "prefix_collisions": dict(field_count=10, choice_count=5, prefix_collisions=True),
+        "long_choices": dict(field_count=3, choice_count=500),
+    }
+    results = {}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for name, options in sorted(suites.items()):
+            form_class = build_form(**options)
+            corpus = generate_corpus(form_class, messages, seed=seed)
+            results[name] = run_benchmark(form_class(), corpus)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark SMS form processing")
+    parser.add_argument("--messages", type=int, default=2000,
+                        help="messages per benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the results to as JSON")
+    parser.add_argument("--compare", help="JSON results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="throughput drop that counts as a regression")
+    args = parser.parse_args(argv)
+
+    results = run_suite(args.messages, args.seed)
+    for benchmark, stages in sorted(results.items()):
+        for stage in STAGES:
+            summary = stages[stage]
+            print "{benchmark:<20} {stage:<15} {rate:>12.0f} msg/s  p50 {p50:.1f}us  p99 {p99:.1f}us".format(
+                benchmark=benchmark, stage=stage, rate=summary["messages_per_second"],
+                p50=summary["p50_us"], p99=summary["p99_us"])
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(baseline, results, args.threshold)
+        for benchmark, stage, baseline_rate, current_rate in regressions:
+            print "REGRESSION {benchmark} {stage}: {baseline:.0f} -> {current:.0f} msg/s".format(
+                benchmark=benchmark, stage=stage, baseline=baseline_rate, current=current_rate)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
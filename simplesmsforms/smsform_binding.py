@@ -0,0 +1,192 @@
+import re
+import warnings
+
+from smsform_exceptions import AmbiguousPrefixWarning
+
+# FIELD BINDING
+
+
+def to_string(item):
+    if isinstance(item, list):
+        return ",".join(item)
+    if isinstance(item, str):
+        return item
+
+
+def tokenize(text):
+    """Splits a message into its tokens on any run of whitespace"""
+    return text.split()
+
+
+def find_ambiguous_prefixes(fields):
+    """Return a list of (prefix, field name, longer prefix, field name) for
+    every prefix that is equal to or starts another field's prefix"""
+    prefix_owners = [(prefix.lower(), field) for field in fields
+                     for prefix in field.prefixes if prefix]
+    ambiguous = []
+    for prefix, field in prefix_owners:
+        for other_prefix, other_field in prefix_owners:
+            if other_field is field or not other_prefix.startswith(prefix):
+                continue
+            if other_prefix == prefix and \
+                    (other_prefix, other_field.name, prefix, field.name) in ambiguous:
+                continue
+            ambiguous.append((prefix, field.name, other_prefix, other_field.name))
+    return ambiguous
+
+
+def warn_ambiguous(form_name, ambiguous_prefixes, stacklevel=2):
+    """Warns about every ambiguous prefix, stacklevel is that of the caller"""
+    for prefix, field_name, other_prefix, other_field_name in ambiguous_prefixes:
+        warnings.warn(
+            "{form}: prefix '{prefix}' of {field} is ambiguous with prefix "
+            "'{other_prefix}' of {other_field}".format(
+                form=form_name, prefix=prefix, field=field_name,
+                other_prefix=other_prefix, other_field=other_field_name),
+            AmbiguousPrefixWarning, stacklevel=stacklevel + 1)
+
+
+class PrefixTrie(object):
+
+    """A character trie holding every prefix of a form. Lookups walk the
+    token once and return the longest prefix it starts with."""
+
+    def __init__(self):
+        self.root = {}
+
+    def insert(self, prefix, value):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[None] = (prefix, value)
+
+    def longest_match(self, text):
+        """Return (prefix, value) for the longest stored prefix of text or
+        (None, None) when no prefix matches"""
+        node = self.root
+        match = (None, None)
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                match = node[None]
+        return match
+
+
+class FieldBinder(object):
+
+    """Compiles the prefixes of a list of fields once so that a message can be
+    bound in a single walk over its tokens.
+
+    How tokens are bound depends on binding:
+    "prefix"     tokens bind to fields by prefix, fields that only expose a
+                 pattern (choice and date fields, or fields declared without
+                 a prefix) are tried in field order against the tokens that
+                 no prefix claimed. A token no pattern matches is then bound
+                 to the first fuzzy choice field it is a misspelling of
+    "positional" the nth token binds to the nth field, a token equal to
+                 blank_field skips its field
+    "hybrid"     tokens with a prefix bind by prefix, the rest bind by
+                 position to the fields no prefix claimed"""
+
+    bindings = ("prefix", "positional", "hybrid")
+
+    def __init__(self, fields, binding="prefix", blank_field=None):
+        if binding not in self.bindings:
+            raise ValueError("binding must be one of {bindings}".format(
+                bindings=", ".join(self.bindings)))
+        self.binding = binding
+        self.blank_field = blank_field
+        self.fields = tuple(fields)
+        self.trie = PrefixTrie()
+        self.pattern_fields = []
+        self.fuzzy_fields = []
+
+        for field in self.fields:
+            field.freeze()
+            value_regex = re.compile(field.value_regex)
+            for prefix_regex in field.get_field_regex():
+                prefix = prefix_regex["prefix"]
+                if prefix:
+                    # The first field to declare a prefix keeps it
+                    if self.trie.longest_match(prefix.lower())[0] != prefix.lower():
+                        self.trie.insert(prefix.lower(), (field, prefix, value_regex))
+                else:
+                    compiled_regex = re.compile(prefix_regex["regex"], re.IGNORECASE)
+                    self.pattern_fields.append((field, compiled_regex))
+            if getattr(field, "fuzzy", False):
+                self.fuzzy_fields.append(field)
+
+        self.ambiguous_prefixes = find_ambiguous_prefixes(self.fields)
+
+    def warn_ambiguous(self, form_name):
+        if self.binding == "positional":
+            return
+        warn_ambiguous(form_name, self.ambiguous_prefixes, stacklevel=3)
+
+    def bind_message(self, text):
+        """Binds the tokens of a message, leaving out the keyword"""
+        return self.bind(tokenize(text)[1:])
+
+    def bind(self, tokens, fields=None):
+        """Binds tokens to fields and returns a tuple of
+        (field, (prefix, value)) in field order. When fields is given only
+        those fields are bound, tokens for any other field are ignored"""
+        only_fields = fields
+        if fields is None:
+            fields = self.fields
+        else:
+            fields = [field for field in self.fields if field in only_fields]
+        matches = {}
+        if self.binding == "positional":
+            self.bind_positions(tokens, fields, matches)
+        else:
+            unclaimed_tokens = self.bind_prefixes(tokens, matches)
+            if self.binding == "hybrid":
+                unbound_fields = [field for field in fields if field not in matches]
+                self.bind_positions(unclaimed_tokens, unbound_fields, matches)
+            else:
+                self.bind_patterns(unclaimed_tokens, matches, only_fields)
+
+        return tuple(
+            (field, (matches[field][0], to_string(matches[field][1])))
+            for field in fields if field in matches)
+
+    def bind_prefixes(self, tokens, matches):
+        """Binds tokens by longest prefix match and returns the tokens no
+        prefix claimed"""
+        unclaimed_tokens = []
+        for token in tokens:
+            prefix, bound = self.trie.longest_match(token.lower())
+            if bound is None or token == self.blank_field:
+                unclaimed_tokens.append(token)
+                continue
+            field, accepted_prefix, value_regex = bound
+            value = value_regex.match(token, len(prefix)).group()
+            matches.setdefault(field, (accepted_prefix, []))[1].append(value)
+        return unclaimed_tokens
+
+    def bind_patterns(self, tokens, matches, fields=None):
+        pattern_fields = self.pattern_fields
+        fuzzy_fields = self.fuzzy_fields
+        if fields is not None:
+            pattern_fields = [(field, compiled_regex) for field, compiled_regex
+                              in pattern_fields if field in fields]
+            fuzzy_fields = [field for field in fuzzy_fields if field in fields]
+        for token in tokens:
+            for field, compiled_regex in pattern_fields:
+                found = compiled_regex.findall(token)
+                if found:
+                    matches.setdefault(field, ("", []))[1].extend(found)
+                    break
+            else:
+                for field in fuzzy_fields:
+                    if field.matches_fuzzy(token):
+                        matches.setdefault(field, ("", []))[1].append(token)
+                        break
+
+    def bind_positions(self, tokens, fields, matches):
+        for field, token in zip(fields, tokens):
+            if token != self.blank_field:
+                matches[field] = ("", [token])
@@ -0,0 +1,220 @@
+import collections
+import cPickle as pickle
+import os
+import sqlite3
+import threading
+import time
+
+# CACHES
+
+_MISSING = object()
+
+
+class LRUCache(object):
+
+    """A thread safe mapping that holds at most max_size items, adding an item
+    to a full cache evicts the least recently used one"""
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.data.pop(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def __getstate__(self):
+        # Cached items are not worth pickling, the cache starts out empty
+        return (self.max_size,)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+
+def normalize_text(text):
+    """Collapses runs of whitespace so retries that only differ in spacing
+    are treated as the same message"""
+    return " ".join(text.split())
+
+
+def estimate_size(value):
+    """A cheap estimate of the bytes value takes, strings count their length
+    and everything else a fixed overhead"""
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return 8 + sum(estimate_size(item) for item in value)
+    if isinstance(value, BaseException):
+        return 16 + estimate_size(value.args)
+    if hasattr(value, "__getstate__"):
+        return estimate_size(value.__getstate__())
+    return 16
+
+
+class MemoryResultBackend(object):
+
+    """Keeps results in memory, evicting the least recently used ones when
+    there are more than max_items or they take up more than max_bytes. The
+    size of a result is estimated from the strings it holds, see
+    estimate_size."""
+
+    def __init__(self, max_items=10000, max_bytes=16 * 1024 * 1024):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, now):
+        with self.lock:
+            entry = self.data.pop(key, None)
+            if entry is None:
+                return None
+            expires, size, result = entry
+            if expires <= now:
+                self.size -= size
+                return None
+            self.data[key] = entry
+            return result
+
+    def set(self, key, result, expires):
+        size = len(key) + estimate_size(result)
+        with self.lock:
+            old_entry = self.data.pop(key, None)
+            if old_entry is not None:
+                self.size -= old_entry[1]
+            self.data[key] = (expires, size, result)
+            self.size += size
+            while self.data and (len(self.data) > self.max_items or self.size > self.max_bytes):
+                self.size -= self.data.popitem(last=False)[1][1]
+
+    def delete(self, key):
+        with self.lock:
+            entry = self.data.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def __len__(self):
+        return len(self.data)
+
+
+class SQLiteResultBackend(object):
+
+    """Keeps pickled results in an SQLite database so several worker
+    processes can share them. Each process opens its own connection, expired
+    results are deleted every purge_every writes."""
+
+    def __init__(self, path, purge_every=1000):
+        self.path = path
+        self.purge_every = purge_every
+        self.writes = 0
+        # The time of the last lookup, results that expired before it are
+        # purged
+        self.now = 0
+        self.connection = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def get_connection(self):
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS smsform_results "
+                "(key TEXT PRIMARY KEY, expires REAL, result BLOB)")
+            self.connection.commit()
+            self.pid = os.getpid()
+        return self.connection
+
+    def get(self, key, now):
+        with self.lock:
+            self.now = now
+            row = self.get_connection().execute(
+                "SELECT result FROM smsform_results WHERE key = ? AND expires > ?",
+                (key, now)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(str(row[0]))
+
+    def set(self, key, result, expires):
+        pickled = sqlite3.Binary(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            connection = self.get_connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO smsform_results (key, expires, result) VALUES (?, ?, ?)",
+                (key, expires, pickled))
+            self.writes += 1
+            if self.writes % self.purge_every == 0:
+                connection.execute("DELETE FROM smsform_results WHERE expires <= ?", (self.now,))
+            connection.commit()
+
+    def delete(self, key):
+        with self.lock:
+            connection = self.get_connection()
+            connection.execute("DELETE FROM smsform_results WHERE key = ?", (key,))
+            connection.commit()
+
+
+class ResultCache(object):
+
+    """Remembers the results of processed messages for ttl seconds, keyed by
+    form keyword, sender and whitespace normalized text, so a message the
+    gateway delivers again is answered from the cache and flagged as a
+    duplicate instead of being processed again.
+    USAGE
+
+    PersonForm.result_cache = ResultCache(ttl=3600)
+    result = PersonForm().process_form(text, sender="+260971000000")
+    if result.duplicate:
+        ...
+    """
+
+    def __init__(self, backend=None, ttl=3600, clock=time.time):
+        self.backend = backend if backend is not None else MemoryResultBackend()
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, form, sender, text):
+        return u"\x00".join([form.keyword.lower(), unicode(sender), normalize_text(text)])
+
+    def process(self, form, sender, text, process):
+        """Returns the cached result for the message, or the result of
+        process(text) which is then cached. The cache keeps its own copy, so
+        callers are free to change the result they get"""
+        key = self.get_key(form, sender, text)
+        now = self.clock()
+        result = self.backend.get(key, now)
+        if result is not None:
+            self.hits += 1
+            return result.as_duplicate()
+        self.misses += 1
+        result = process(text)
+        self.backend.set(key, result.copy(), now + self.ttl)
+        return result
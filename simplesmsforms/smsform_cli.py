@@ -0,0 +1,177 @@
+import argparse
+import contextlib
+import csv
+import importlib
+import itertools
+import json
+import mmap
+import sys
+import timeit
+
+import smsform_batch
+
+# COMMAND LINE
+
+
+def load_form_class(path):
+    """Imports a form class from a "module:Class" or "module.Class" path"""
+    if ":" in path:
+        module_name, class_name = path.split(":", 1)
+    else:
+        module_name, _, class_name = path.rpartition(".")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+@contextlib.contextmanager
+def open_lines(path):
+    """Yields an iterator over the lines of path, memory mapping the file
+    when it can be mapped"""
+    if path == "-":
+        yield iter(sys.stdin.readline, "")
+        return
+    with open(path, "rb") as input_file:
+        try:
+            mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            # Empty files and pipes can not be mapped
+            yield iter(input_file.readline, "")
+            return
+        try:
+            yield iter(mapped.readline, "")
+        finally:
+            mapped.close()
+
+
+def read_records(lines, input_format):
+    """Yields every record of a JSONL or CSV file as a dict, a line that is
+    not valid JSON is yielded as the ValueError it raised"""
+    if input_format == "csv":
+        reader = csv.reader(lines)
+        header = next(reader, [])
+        for row in reader:
+            yield dict(zip(header, row))
+        return
+    for line in lines:
+        line = line.strip()
+        if line:
+            try:
+                yield json.loads(line)
+            except ValueError, e:
+                yield e
+
+
+def read_texts(records, text_field, invalid_records):
+    """Yields the message text of every record. Records that can not be read
+    or have no text are kept in invalid_records by index, with the error,
+    and yield an empty text so the indexes of later records do not change"""
+    for index, record in enumerate(records):
+        if isinstance(record, ValueError):
+            error = record
+        elif not isinstance(record, dict) or text_field not in record:
+            error = ValueError("The record has no {field} field".format(field=text_field))
+        elif not isinstance(record[text_field], basestring):
+            error = ValueError("The {field} field is not a string".format(field=text_field))
+        else:
+            yield record[text_field]
+            continue
+        invalid_records[index] = error
+        yield ""
+
+
+def to_json_value(value):
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+def result_to_json(index, result):
+    return json.dumps({
+        "index": index,
+        "valid": result.valid,
+        "fields": result.to_dict(),
+        "errors": [{"type": error.__class__.__name__, "message": str(error)}
+                   for error in result.errors],
+    }, default=to_json_value, sort_keys=True)
+
+
+def invalid_record_to_json(index, error):
+    return json.dumps({
+        "index": index,
+        "valid": False,
+        "fields": {},
+        "errors": [{"type": "InvalidRecord", "message": str(error)}],
+    }, sort_keys=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Process a JSONL or CSV file of messages with an SMS form")
+    parser.add_argument("form", help='the form class, as "module:Class"')
+    parser.add_argument("input", help='JSONL or CSV file of messages, "-" for stdin')
+    parser.add_argument("--format", choices=["jsonl", "csv"],
+                        help="input format, guessed from the file extension by default")
+    parser.add_argument("--text-field", default="text",
+                        help="the record field holding the message text")
+    parser.add_argument("--output", default="-", help="JSONL file to write results to")
+    parser.add_argument("--errors", help="JSONL file to write invalid results to "
+                                         "instead of the output")
+    parser.add_argument("--offset", type=int, default=0,
+                        help="number of records to skip, to resume an earlier run")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--chunksize", type=int, default=500)
+    parser.add_argument("--progress-every", type=int, default=100000,
+                        help="report throughput every this many messages")
+    parser.add_argument("--quiet", action="store_true", help="do not report progress")
+    args = parser.parse_args(argv)
+
+    input_format = args.format or ("csv" if args.input.endswith(".csv") else "jsonl")
+    form = load_form_class(args.form)()
+    # Resumed runs add to the results of the earlier run
+    mode = "a" if args.offset else "w"
+    output = sys.stdout if args.output == "-" else open(args.output, mode)
+    errors_output = open(args.errors, mode) if args.errors else output
+
+    timer = timeit.default_timer
+    start = timer()
+    count = 0
+    # Records that could not be read, by index, they are written to the
+    # errors output instead of being processed
+    invalid_records = {}
+    finished = False
+    try:
+        with open_lines(args.input) as lines:
+            records = itertools.islice(read_records(lines, input_format), args.offset, None)
+            texts = read_texts(records, args.text_field, invalid_records)
+            for index, result in smsform_batch.process_many(
+                    form, texts, workers=args.workers, chunksize=args.chunksize):
+                error = invalid_records.pop(index, None)
+                if error is not None:
+                    errors_output.write(invalid_record_to_json(args.offset + index, error) + "\n")
+                else:
+                    target = output if result.valid else errors_output
+                    target.write(result_to_json(args.offset + index, result) + "\n")
+                count += 1
+                if not args.quiet and count % args.progress_every == 0:
+                    sys.stderr.write("{count} messages, {rate:.0f} msg/s\n".format(
+                        count=count, rate=count / (timer() - start)))
+        finished = True
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        if errors_output is not output:
+            errors_output.close()
+        # Results are written in order, so a failed run can be resumed from
+        # the first record without a result
+        if not finished:
+            sys.stderr.write("Stopped after {count} messages, resume with --offset "
+                             "{offset}\n".format(count=count, offset=args.offset + count))
+
+    elapsed = timer() - start
+    if not args.quiet:
+        sys.stderr.write("Processed {count} messages in {elapsed:.1f}s, next offset {offset}\n".format(
+            count=count, elapsed=elapsed, offset=args.offset + count))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
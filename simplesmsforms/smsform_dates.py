@@ -0,0 +1,163 @@
+import datetime
+import re
+
+from smsform_cache import LRUCache
+
+# DATE PARSING
+
+MONTH_ABBREVIATIONS = ["jan", "feb", "mar", "apr", "may", "jun",
+                       "jul", "aug", "sep", "oct", "nov", "dec"]
+MONTH_NAMES = ["january", "february", "march", "april", "may", "june", "july",
+               "august", "september", "october", "november", "december"]
+MONTHS = dict(
+    [(name, number) for number, name in enumerate(MONTH_ABBREVIATIONS, 1)] +
+    [(name, number) for number, name in enumerate(MONTH_NAMES, 1)]
+)
+
+# The strptime directives a date format can be compiled from, they accept the
+# same input strptime does in the C locale
+DIRECTIVE_REGEXES = {
+    "d": r"(?P<day>\d{1,2})",
+    "m": r"(?P<month>\d{1,2})",
+    "b": r"(?P<month_name>{names})".format(names="|".join(MONTH_ABBREVIATIONS)),
+    "B": r"(?P<month_name>{names})".format(names="|".join(MONTH_NAMES)),
+    "y": r"(?P<short_year>\d{2})",
+    "Y": r"(?P<year>\d{4})",
+    "%": "%",
+}
+DIGIT_DIRECTIVES = "dmyY"
+NAME_DIRECTIVES = "bB"
+
+
+def compile_date_format(date_format):
+    """Compiles a strptime format into a regex, returns None if the format
+    uses a directive that has no compiled equivalent"""
+    regex = []
+    chars = iter(date_format)
+    for char in chars:
+        if char != "%":
+            regex.append(re.escape(char))
+            continue
+        directive_regex = DIRECTIVE_REGEXES.get(next(chars, None))
+        if directive_regex is None:
+            return None
+        regex.append(directive_regex)
+    try:
+        return re.compile("".join(regex) + r"\Z", re.IGNORECASE)
+    except re.error:
+        # A directive used twice gives a duplicate group name
+        return None
+
+
+def get_format_shape(date_format):
+    """Returns the runs a date string in date_format is made of, "9" for a
+    run of digits, "a" for a run of letters and the separators as they are,
+    e.g. "9/a/9" for "%d/%b/%y". Returns None for formats with letters or
+    digits outside a directive, their strings have no fixed shape"""
+    shape = []
+    chars = iter(date_format)
+    for char in chars:
+        if char == "%":
+            directive = next(chars, None)
+            if directive in DIGIT_DIRECTIVES:
+                run = "9"
+            elif directive in NAME_DIRECTIVES:
+                run = "a"
+            elif directive == "%":
+                shape.append("%")
+                continue
+            else:
+                return None
+            if not shape or shape[-1] != run:
+                shape.append(run)
+        elif char.isalnum():
+            return None
+        else:
+            shape.append(char)
+    return "".join(shape)
+
+
+class DateFormat(object):
+
+    def __init__(self, date_format):
+        self.date_format = date_format
+        self.regex = compile_date_format(date_format)
+        self.shape = get_format_shape(date_format) if self.regex is not None else None
+        self.hits = 0
+
+    def overlaps(self, other):
+        """Returns False when no string can be in both formats, that is when
+        both have a fixed shape and the shapes differ"""
+        return self.shape is None or other.shape is None or self.shape == other.shape
+
+    def parse(self, date_string):
+        """Returns a date or None if date_string is not in this format"""
+        if self.regex is None:
+            try:
+                return datetime.datetime.strptime(date_string, self.date_format).date()
+            except ValueError:
+                return None
+
+        match = self.regex.match(date_string)
+        if match is None:
+            return None
+        parts = match.groupdict()
+        if parts.get("month_name"):
+            month = MONTHS[parts["month_name"].lower()]
+        else:
+            month = int(parts.get("month") or 1)
+        if parts.get("short_year"):
+            # Same pivot as strptime, 69-99 are 1900s and 00-68 are 2000s
+            year = int(parts["short_year"])
+            year += 2000 if year <= 68 else 1900
+        else:
+            year = int(parts.get("year") or 1900)
+        try:
+            return datetime.date(year, month, int(parts.get("day") or 1))
+        except ValueError:
+            return None
+
+
+class DateParser(object):
+
+    """Parses date strings against a list of formats. Formats are compiled to
+    regexes once, are tried in order of how often they matched, and recently
+    parsed strings are remembered in an LRU cache.
+
+    A string in more than one format is parsed with the format declared
+    first, so formats only move past formats that can not match the same
+    strings, "%d/%m/%Y" never moves past "%m/%d/%Y" or the other way."""
+
+    def __init__(self, date_formats, cache_size=1000):
+        self.formats = tuple(DateFormat(date_format) for date_format in date_formats)
+        self.cache = LRUCache(cache_size) if cache_size else None
+
+    def parse(self, date_string):
+        """Returns a date or None if date_string is not in any of the formats"""
+        if self.cache is not None:
+            key = date_string.lower()
+            python_date = self.cache.get(key, False)
+            if python_date is False:
+                python_date = self.parse_formats(date_string)
+                self.cache.set(key, python_date)
+            return python_date
+        return self.parse_formats(date_string)
+
+    def parse_formats(self, date_string):
+        formats = self.formats
+        for position, date_format in enumerate(formats):
+            python_date = date_format.parse(date_string)
+            if python_date is not None:
+                date_format.hits += 1
+                if position and date_format.hits > formats[position - 1].hits and \
+                        not date_format.overlaps(formats[position - 1]):
+                    self.promote(position)
+                return python_date
+        return None
+
+    def promote(self, position):
+        """Swaps the format at position with the one before it, the formats
+        tuple is replaced rather than changed so concurrent parses are safe"""
+        formats = list(self.formats)
+        formats[position - 1], formats[position] = formats[position], formats[position - 1]
+        self.formats = tuple(formats)
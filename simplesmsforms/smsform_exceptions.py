@@ -1,6 +1,7 @@
 class SMSFieldException(Exception):
 
     def __init__(self, field):
+        super(SMSFieldException, self).__init__(field)
         self.field = field
 
     def __str__(self):
@@ -20,4 +21,40 @@ class InvalidDateException(SMSFieldException):
 
 
 class ChoiceException(SMSFieldException):
-    pass
\ No newline at end of file
+    pass
+
+
+class InvalidNumberException(SMSFieldException):
+    pass
+
+
+class NumberRangeException(SMSFieldException):
+    pass
+
+
+class UnknownKeywordException(SMSFieldException):
+
+    def __str__(self):
+        return "The keyword '{keyword}' does not match any form.".format(
+            keyword=self.field
+        )
+
+
+class MessageTooLongException(SMSFieldException):
+
+    def __str__(self):
+        return "The message is longer than {max_length} characters.".format(
+            max_length=self.field
+        )
+
+
+class MessageTimeoutException(SMSFieldException):
+
+    def __str__(self):
+        return "The message took longer than {time_budget} seconds to process.".format(
+            time_budget=self.field
+        )
+
+
+class AmbiguousPrefixWarning(UserWarning):
+    pass
@@ -1,29 +1,69 @@
-import datetime
+import decimal
 import re
 
 from smsform_exceptions import (SMSFieldException, ChoiceException, InvalidDateException,
-                                MissingRequiredFieldException)
-from smsform_validators import multiple_choice_validator, single_choice_validator
+                                MissingRequiredFieldException, InvalidNumberException,
+                                NumberRangeException)
+from smsform_validators import (multiple_choice_validator, single_choice_validator,
+                                 lowercase_list_util)
+from smsform_fuzzy import BKTree
+from smsform_dates import DateParser
+from smsform_cache import LRUCache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # SMS FIELD
 
 
 class GenericSMSField(object):
-    empty_values = [None, [], ""]
 
+    """A field definition. Once a form compiles it the field is frozen, it is
+    shared by every message and thread the form processes so all per message
+    state is passed around instead of being stored on the field.
+
+    With memo_size set, process_field remembers the result, or the
+    SMSFieldException, of the last memo_size (text, prefix) pairs it saw.
+    Fields that are pure, their result only depends on the text and prefix,
+    memoize DEFAULT_MEMO_SIZE pairs unless memo_size is 0."""
 
-    def __init__(self, name, *args, **kwargs):
+    DEFAULT_MEMO_SIZE = 1000
+
+    empty_values = [None, [], ""]
+    # The characters a prefixed value is made of
+    value_regex = r"\w*"
+    frozen = False
+    pure = False
+    # The (form class, attribute name) a compiled field is declared as, such
+    # fields are pickled as a reference to that attribute
+    owner = None
+    # Incremented for every field created so forms can keep their fields in
+    # the order they were declared
+    creation_counter = 0
+
+
+    def __init__(self, name=None, *args, **kwargs):
+        """name can be left out for fields declared on a form, they are named
+        after the attribute they are assigned to"""
         self.name = name
-        self.validators = kwargs.get('validators') or []
-        self.prefixes = kwargs.get("prefixes") or [""]
-        self.prefixes.sort(key=len, reverse=True)#Longest prefix should come first
-        self.accepted_prefix = ""
+        self.creation_counter = GenericSMSField.creation_counter
+        GenericSMSField.creation_counter += 1
+        self.validators = tuple(kwargs.get('validators') or ())
+        #Longest prefix should come first
+        self.prefixes = tuple(sorted(kwargs.get("prefixes") or [""], key=len, reverse=True))
 
         required = kwargs.get("required", "blank")
         if required == "blank":
             self.required = True
         else:
-            self.required = False
+            self.required = bool(required)
+
+        memo_size = kwargs.get("memo_size")
+        if memo_size is None and self.pure:
+            memo_size = self.DEFAULT_MEMO_SIZE
+        self.memo = LRUCache(memo_size) if memo_size else None
 
 
     def get_field_regex(self):
@@ -31,7 +71,7 @@ class GenericSMSField(object):
         prefix_regexes = []
         for prefix in self.prefixes:
             prefix_regex = r"\b{prefix}(?P<{name}>\w*)".format(
-                prefix=prefix,
+                prefix=re.escape(prefix),
                 name=self.name
             )
             prefix_regexes.append({"prefix": prefix, "regex": prefix_regex})
@@ -45,8 +85,6 @@ class GenericSMSField(object):
         """Convert the passed in text to a valid python object, any special
         conversions from the passed in text to a valid python object should
         happen here."""
-        self.accepted_prefix = self.accepted_prefix or accepted_prefix
-
         return text, accepted_prefix
 
     def validate(self, value):
@@ -62,12 +100,57 @@ class GenericSMSField(object):
         return True
 
     def process_field(self, text, accepted_prefix=""):
+        if self.memo is None:
+            return self.convert_field(text, accepted_prefix)
+        key = (text, accepted_prefix)
+        memoized = self.memo.get(key)
+        if memoized is None:
+            try:
+                memoized = (True, self.convert_field(text, accepted_prefix))
+            except SMSFieldException, e:
+                memoized = (False, e)
+            self.memo.set(key, memoized)
+        converted, value = memoized
+        if not converted:
+            raise value
+        return self.copy_value(value)
+
+    def check_field(self, text, accepted_prefix=""):
+        """Raises the SMSFieldException process_field would raise for text
+        without returning a python value. Fields that can tell a text is
+        valid without converting it override this"""
+        self.process_field(text, accepted_prefix)
+
+    def convert_field(self, text, accepted_prefix=""):
         # Try to split into text and the accepted prefix
 
         python_obj, accepted_prefix = self.to_python(text, accepted_prefix)
         self.validate(python_obj)
         return python_obj
 
+    def copy_value(self, value):
+        """Returns a copy of a memoized value that the caller is free to
+        change, values that can not be changed are returned as they are"""
+        return value
+
+    def freeze(self):
+        object.__setattr__(self, "frozen", True)
+
+    def set_owner(self, form_class, attribute_name):
+        if self.owner is None:
+            object.__setattr__(self, "owner", (form_class, attribute_name))
+
+    def __reduce_ex__(self, protocol):
+        if self.owner is not None:
+            return getattr, self.owner
+        return super(GenericSMSField, self).__reduce_ex__(protocol)
+
+    def __setattr__(self, name, value):
+        if self.frozen:
+            raise AttributeError(
+                "{field} can not be changed once it is used by a form".format(field=self))
+        super(GenericSMSField, self).__setattr__(name, value)
+
     def __repr__(self):
         return "<{name}> object".format(name=self.name)
 
@@ -81,26 +164,83 @@ class PrefixField(GenericSMSField):
 
 
 class MultiChoiceField(GenericSMSField):
+    pure = True
+    # check_field only skips conversion for fields validated by these alone
+    choice_validators = (multiple_choice_validator,)
+    max_choices = None
 
     def __init__(self, choices, choice_divider=",", *args, **kwargs):
         self.choice_divider = choice_divider
         self.choices = choices
+        # Lower cased choices mapped to the choice as it was declared
+        self.choice_map = dict(zip(lowercase_list_util(choices), choices))
+        self.choice_index = frozenset(self.choice_map)
+        self.fuzzy = kwargs.get("fuzzy", False)
+        self.max_distance = kwargs.get("max_distance", 1)
+        self.choice_tree = BKTree(self.choice_index) if self.fuzzy else None
+        self.value_regex = r"[\w{divider}]*".format(divider=re.escape(choice_divider))
         super(MultiChoiceField, self).__init__(*args, **kwargs)
-        self.validators.append(multiple_choice_validator)
+        self.validators += (multiple_choice_validator,)
+        # Choices are matched literally against the whole token, so a word
+        # that only starts with a choice is not taken for it
+        choices_string = "|".join(
+            re.escape(choice) for choice in sorted(self.choices, key=len, reverse=True))
+        self.choice_regexes = [
+            {
+                "prefix": "", "regex": r"\A(?:{choices})(?:{divider}(?:{choices}))*\Z".format(
+                    choices=choices_string, divider=re.escape(choice_divider))
+            }
+        ]
 
     def to_python(self, text, accepted_prefix):
         text, accepted_prefix = super(
             MultiChoiceField, self).to_python(text, accepted_prefix)
 
-        return text.split(self.choice_divider), accepted_prefix
+        values = text.split(self.choice_divider)
+        if self.choice_tree is not None:
+            values = [self.correct_choice(value) for value in values]
+        return values, accepted_prefix
+
+    def copy_value(self, value):
+        return list(value)
+
+    def check_field(self, text, accepted_prefix=""):
+        # A text made up of declared choices is valid, anything else is
+        # processed to raise the exception process_field would
+        if text and self.validators == self.choice_validators:
+            values = text.lower().split(self.choice_divider)
+            if (self.max_choices is None or len(values) <= self.max_choices) and \
+                    self.choice_index.issuperset(values):
+                return
+        self.process_field(text, accepted_prefix)
+
+    def correct_choice(self, value):
+        """Returns the choice closest to value within max_distance edits or
+        value itself when it is already a choice or nothing is close enough"""
+        normalized_value = value.lower()
+        if normalized_value in self.choice_index:
+            return value
+        corrected = self.choice_tree.closest(normalized_value, self.max_distance)
+        if corrected is None:
+            return value
+        return self.choice_map[corrected]
+
+    def matches_fuzzy(self, token):
+        """Returns True when every choice in token is a choice or is close
+        enough to one to be corrected, the binder uses this to bind misspelt
+        choices that have no prefix"""
+        if self.choice_tree is None or not token:
+            return False
+        for value in token.lower().split(self.choice_divider):
+            if value not in self.choice_index and \
+                    self.choice_tree.closest(value, self.max_distance) is None:
+                return False
+        return True
 
     def get_field_regex(self):
-        choices_string = "|".join(self.choices)
-        return [
-            {
-                "prefix": "", "regex": "({choices_string})".format(choices_string=choices_string)
-            }
-        ]
+        if self.prefixes != ("",):
+            return super(MultiChoiceField, self).get_field_regex() + self.choice_regexes
+        return self.choice_regexes
 
     def validate(self, value):
         # check to see if the field is required and present
@@ -109,24 +249,34 @@ class MultiChoiceField(GenericSMSField):
 
         for validator in self.validators:
             try:
-                validator(value=value, choices=self.choices)
+                validator(value=value, choices=self.choices, choice_index=self.choice_index)
             except SMSFieldException, e:
                 raise
         return True
 
 class SingleChoiceField(MultiChoiceField):
+    choice_validators = (single_choice_validator,)
+    max_choices = 1
 
     def __init__(self, choices, *args, **kwargs):
         super(SingleChoiceField, self).__init__(choices, *args, **kwargs)
-        self.validators = [single_choice_validator]
+        self.validators = (single_choice_validator,)
 
 
 class DateField(GenericSMSField):
-
-    def __init__(self, name, *args, **kwargs):
-        date_formats = kwargs.get("date_formats", None) or ["%d/%b/%y", "%d%b%y"]
+    pure = True
+    value_regex = r"[\w/-]*"
+
+    def __init__(self, name=None, *args, **kwargs):
+        date_formats = kwargs.get("date_formats", None) or [
+            "%d/%b/%y", "%d%b%y", "%d/%m/%Y", "%d/%m/%y", "%d-%m-%Y", "%d-%m-%y"]
+        if "cache_size" in kwargs:
+            # cache_size used to size the parser's cache, the field's memo
+            # does that job now
+            kwargs.setdefault("memo_size", kwargs["cache_size"])
         super(DateField, self).__init__(name, *args, **kwargs)
         self.date_formats = date_formats
+        self.date_parser = DateParser(date_formats, cache_size=0)
 
     def get_field_regex(self):
         """We will accept 2 formats for the dates: dayMonthYear, day/Month/Year
@@ -136,26 +286,163 @@ class DateField(GenericSMSField):
             r"\b\d{1,2}[-/]\d{1,2}[-/]\d{1,4}\b",
             r"\b\d{1,2}[a-z]{3,14}\d{1,4}\b",
         ]
-        return [
+        date_regexes = [
             {
                 "prefix": "", "regex": "{regex_strings}".format(regex_strings="|".join(regex_strings), name=self.name)
             }
         ]
+        if self.prefixes != ("",):
+            return super(DateField, self).get_field_regex() + date_regexes
+        return date_regexes
 
     def to_python(self, date_string, accepted_prefix=""):
-        python_date = None
-        for date_format in self.date_formats:
-            try:
-                python_date = datetime.datetime.strptime(
-                    date_string, date_format)
-            except ValueError:
-                continue
-            else:
-                break
+        python_date = self.date_parser.parse(date_string)
 
         if not python_date:
             raise InvalidDateException(
                 "Date not recognized, please use the format: dayMonthYear"
             )
 
-        return python_date.date(), accepted_prefix
+        return python_date, accepted_prefix
+
+
+class NumberField(GenericSMSField):
+
+    """Base for numeric fields. Values can end in one of the declared units,
+    units can be a list of suffixes or a dict of suffix to the multiplier
+    that converts it to the field's base unit, e.g. {"kg": 1000, "g": 1}.
+    Multipliers must be numbers the field can hold, a ValueError is raised
+    for e.g. an IntegerField unit of 0.5. min_value and max_value bound the
+    converted value."""
+
+    number_regex = None
+    # Matches the texts process_column can hand to numpy, numbers without a
+    # unit
+    plain_number_regex = None
+    numpy_dtype = None
+
+    def __init__(self, name=None, *args, **kwargs):
+        units = kwargs.get("units") or {}
+        if not isinstance(units, dict):
+            units = dict((unit, 1) for unit in units)
+        self.units = dict((unit.lower(), self.convert_multiplier(unit, multiplier))
+                          for unit, multiplier in units.items())
+        self.min_value = kwargs.get("min_value")
+        self.max_value = kwargs.get("max_value")
+        super(NumberField, self).__init__(name, *args, **kwargs)
+
+    def convert_multiplier(self, unit, multiplier):
+        try:
+            return self.convert(str(multiplier))
+        except (ValueError, TypeError, ArithmeticError):
+            raise ValueError("The multiplier {multiplier!r} of unit '{unit}' is not a valid "
+                             "{field_type} value".format(
+                                 multiplier=multiplier, unit=unit,
+                                 field_type=type(self).__name__))
+
+    def convert(self, number):
+        raise NotImplementedError
+
+    def to_python(self, text, accepted_prefix=""):
+        if text in self.empty_values:
+            return None, accepted_prefix
+
+        match = self.number_regex.match(text)
+        if match is None:
+            raise InvalidNumberException(
+                "{value} is not a valid number for {field}".format(
+                    value=text, field=self.get_verbose_name()))
+        number, unit = match.groups()
+        multiplier = self.units.get(unit.lower()) if unit else 1
+        if multiplier is None:
+            raise InvalidNumberException(
+                "{unit} is not a valid unit for {field}, please use one of: {units}".format(
+                    unit=unit, field=self.get_verbose_name(),
+                    units=", ".join(sorted(self.units))))
+        value = self.convert(number)
+        if multiplier != 1:
+            value *= multiplier
+        return value, accepted_prefix
+
+    def validate(self, value):
+        super(NumberField, self).validate(value)
+        if value is not None:
+            self.validate_range(value)
+        return True
+
+    def validate_range(self, value):
+        if (self.min_value is not None and value < self.min_value) or \
+                (self.max_value is not None and value > self.max_value):
+            raise NumberRangeException(self.get_range_message(value))
+
+    def get_range_message(self, value):
+        return "{value} is out of range for {field}, it must be between {min_value} and {max_value}".format(
+            value=value, field=self.get_verbose_name(),
+            min_value=self.min_value, max_value=self.max_value)
+
+    def process_column(self, texts):
+        """Converts and validates a column of values at once, returns a list
+        holding each value or the SMSFieldException it raised, the same
+        value or exception process_field gives for each text.
+
+        This is for callers that already hold a column of values, such as a
+        CSV import, process_form and the batch functions process messages
+        one at a time. When numpy is installed, the field has a numpy_dtype
+        and no validators, and every text is a number without a unit, the
+        column is converted and range checked as one array. Otherwise each text
+        is processed on its own."""
+        if numpy is not None and self.numpy_dtype is not None and texts and \
+                not self.validators and self.is_plain_column(texts):
+            try:
+                array = numpy.array(texts, dtype=self.numpy_dtype)
+            except (ValueError, TypeError, OverflowError):
+                array = None
+            if array is not None:
+                return self.process_array(array)
+        return [self.process_value(text) for text in texts]
+
+    def is_plain_column(self, texts):
+        match = self.plain_number_regex.match
+        for text in texts:
+            if not isinstance(text, basestring) or match(text) is None:
+                return False
+        return True
+
+    def process_array(self, array):
+        out_of_range = numpy.zeros(len(array), dtype=bool)
+        if self.min_value is not None:
+            out_of_range |= array < self.min_value
+        if self.max_value is not None:
+            out_of_range |= array > self.max_value
+        values = array.tolist()
+        for position in numpy.flatnonzero(out_of_range):
+            values[position] = NumberRangeException(self.get_range_message(values[position]))
+        return values
+
+    def process_value(self, text):
+        try:
+            return self.process_field(text)
+        except SMSFieldException, e:
+            return e
+
+
+class IntegerField(NumberField):
+    value_regex = r"-?\w*"
+    number_regex = re.compile(r"(-?\d+)([a-z]*)\Z", re.IGNORECASE)
+    plain_number_regex = re.compile(r"-?\d+\Z")
+    numpy_dtype = "int64"
+
+    def convert(self, number):
+        return int(number)
+
+
+class DecimalField(NumberField):
+    value_regex = r"-?[\w.]*"
+    number_regex = re.compile(r"(-?\d+(?:\.\d+)?|-?\.\d+)([a-z]*)\Z", re.IGNORECASE)
+    # float64 can not hold every decimal exactly, so a range check on the
+    # array could disagree with the one on the Decimal. Decimal columns are
+    # processed value by value
+    numpy_dtype = None
+
+    def convert(self, number):
+        return decimal.Decimal(number)
@@ -0,0 +1,80 @@
+# FUZZY MATCHING
+
+
+def edit_distance(first, second):
+    """Returns the Levenshtein distance between two strings"""
+    if len(first) < len(second):
+        first, second = second, first
+    previous_row = range(len(second) + 1)
+    for i, first_char in enumerate(first, 1):
+        current_row = [i]
+        for j, second_char in enumerate(second, 1):
+            current_row.append(min(
+                previous_row[j] + 1,
+                current_row[j - 1] + 1,
+                previous_row[j - 1] + (first_char != second_char)
+            ))
+        previous_row = current_row
+    return previous_row[-1]
+
+
+class BKTree(object):
+
+    """A Burkhard-Keller tree over edit distance. Searching for every word
+    within a small distance of a query only visits the branches the triangle
+    inequality allows instead of comparing against every word."""
+
+    def __init__(self, words=()):
+        self.root = None
+        self.size = 0
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        if self.root is None:
+            self.root = (word, {})
+            self.size = 1
+            return
+        node_word, children = self.root
+        while True:
+            distance = edit_distance(word, node_word)
+            if distance == 0:
+                return
+            child = children.get(distance)
+            if child is None:
+                children[distance] = (word, {})
+                self.size += 1
+                return
+            node_word, children = child
+
+    def search(self, word, max_distance):
+        """Returns a list of (distance, word) within max_distance of word,
+        closest first"""
+        if self.root is None:
+            return []
+        found = []
+        candidates = [self.root]
+        while candidates:
+            node_word, children = candidates.pop()
+            distance = edit_distance(word, node_word)
+            if distance <= max_distance:
+                found.append((distance, node_word))
+            for child_distance in range(distance - max_distance, distance + max_distance + 1):
+                child = children.get(child_distance)
+                if child is not None:
+                    candidates.append(child)
+        found.sort()
+        return found
+
+    def closest(self, word, max_distance):
+        """Returns the single closest word within max_distance, or None when
+        there is no match or the closest match is a tie"""
+        found = self.search(word, max_distance)
+        if not found:
+            return None
+        if len(found) > 1 and found[0][0] == found[1][0]:
+            return None
+        return found[0][1]
+
+    def __len__(self):
+        return self.size
@@ -0,0 +1,138 @@
+import collections
+import threading
+import Queue
+
+# INGESTION
+
+_STOP = object()
+
+
+class PendingResult(object):
+
+    """The result of a message handed to a FormIngestor. It is filled in by a
+    worker thread, result() blocks until it is."""
+
+    def __init__(self, text):
+        self.text = text
+        self.value = None
+        self.exception = None
+        self.callbacks = []
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise Queue.Empty("The message is still being processed")
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+    def add_done_callback(self, callback):
+        """Calls callback(pending_result) once the result is ready, straight
+        away when it already is"""
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, value=None, exception=None):
+        with self.lock:
+            self.value = value
+            self.exception = exception
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class FormIngestor(object):
+
+    """Feeds messages from webhook or gateway receivers to a form through a
+    bounded queue. Worker threads take up to batch_size queued messages at a
+    time, so a burst of small messages costs one queue hand off per batch
+    rather than per message, and submit() blocks once max_queue messages are
+    waiting so a traffic spike can not grow memory without bound.
+    USAGE
+
+    ingestor = FormIngestor(PersonForm(), max_queue=1000, workers=2)
+    pending = ingestor.submit("REG fnAndre lnLesa ag12 locLusaka")
+    valid, python_fields, errors = pending.result()
+    """
+
+    def __init__(self, form, max_queue=1000, workers=1, batch_size=20):
+        self.form = form
+        self.batch_size = batch_size
+        self.queue = Queue.Queue(max_queue)
+        self.in_flight = 0
+        self.processed = 0
+        self.lock = threading.Lock()
+        self.workers = []
+        for _ in range(workers):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def submit(self, text, block=True, timeout=None):
+        """Queues text for processing and returns its PendingResult. When the
+        queue is full this waits for space, or raises Queue.Full straight away
+        when block is False"""
+        pending = PendingResult(text)
+        self.queue.put(pending, block, timeout)
+        return pending
+
+    def stream(self, texts):
+        """Submits every text and yields the process_form results in the
+        order the texts came in"""
+        pending_results = collections.deque()
+        for text in texts:
+            pending_results.append(self.submit(text))
+            while pending_results and pending_results[0].done():
+                yield pending_results.popleft().result()
+        while pending_results:
+            yield pending_results.popleft().result()
+
+    def get_batch(self):
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size and batch[-1] is not _STOP:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def work(self):
+        while True:
+            batch = self.get_batch()
+            stop = batch[-1] is _STOP
+            if stop:
+                batch.pop()
+            with self.lock:
+                self.in_flight += len(batch)
+            for pending in batch:
+                try:
+                    pending.set_result(self.form.process_form(pending.text))
+                except Exception, e:
+                    pending.set_result(exception=e)
+            with self.lock:
+                self.in_flight -= len(batch)
+                self.processed += len(batch)
+            if stop:
+                return
+
+    def close(self):
+        """Waits for the queued messages to be processed and stops the
+        workers"""
+        for _ in self.workers:
+            self.queue.put(_STOP)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
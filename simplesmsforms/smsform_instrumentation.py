@@ -0,0 +1,139 @@
+import collections
+import heapq
+import threading
+import timeit
+
+# INSTRUMENTATION
+
+timer = timeit.default_timer
+
+
+class Histogram(object):
+
+    """A latency histogram with power of two microsecond buckets, bucket n
+    counts durations below 2 ** n microseconds"""
+
+    bucket_count = 32
+
+    def __init__(self):
+        self.buckets = [0] * self.bucket_count
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        bucket = min(int(duration * 1e6).bit_length(), self.bucket_count - 1)
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def percentile(self, percent):
+        """Returns the upper bound in seconds of the bucket holding the
+        percentile"""
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for bucket, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if bucket_count and seen >= wanted:
+                return (2 ** bucket) / 1e6
+        return 0.0
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+        }
+
+
+class Instrumentation(object):
+
+    """Collects counters and latencies for the forms it is attached to. Forms
+    only time their stages when an instrumentation is set, so a form without
+    one pays for nothing more than a None check.
+
+    Every processed message is passed to sink, when given, as a dict of the
+    form name, stage timings, validity and error class names. With slowest
+    set, the texts and stage timings of the slowest messages are kept.
+    USAGE
+
+    PersonForm.instrumentation = Instrumentation(slowest=10)
+    ...
+    PersonForm.instrumentation.snapshot()
+    """
+
+    def __init__(self, sink=None, slowest=0):
+        self.sink = sink
+        self.slowest = slowest
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = collections.Counter()
+            self.errors = collections.Counter()
+            self.histograms = collections.defaultdict(Histogram)
+            self.slowest_messages = []
+
+    def time_field(self, form, field, value, prefix):
+        """Runs field.process_field and records its latency and any error"""
+        start = timer()
+        try:
+            return field.process_field(value, prefix)
+        except Exception, e:
+            with self.lock:
+                self.counters[(form.__class__.__name__, field.name, "errors")] += 1
+            raise
+        finally:
+            duration = timer() - start
+            with self.lock:
+                self.counters[(form.__class__.__name__, field.name, "processed")] += 1
+                self.histograms[(form.__class__.__name__, field.name)].add(duration)
+
+    def record_message(self, form, text, timings, result):
+        """Records a processed message, timings maps stage names to
+        durations in seconds"""
+        form_name = form.__class__.__name__
+        error_names = [error.__class__.__name__ for error in result.errors]
+        total = sum(timings.values())
+        with self.lock:
+            self.counters[(form_name, "messages")] += 1
+            if result.valid is None:
+                self.counters[(form_name, "unvalidated")] += 1
+            else:
+                self.counters[(form_name, "valid" if result.valid else "invalid")] += 1
+            for stage, duration in timings.items():
+                self.histograms[(form_name, stage)].add(duration)
+            self.errors.update(error_names)
+            if self.slowest:
+                entry = (total, text, timings)
+                if len(self.slowest_messages) < self.slowest:
+                    heapq.heappush(self.slowest_messages, entry)
+                elif total > self.slowest_messages[0][0]:
+                    heapq.heapreplace(self.slowest_messages, entry)
+        if self.sink is not None:
+            self.sink({
+                "form": form_name,
+                "timings": timings,
+                "valid": result.valid,
+                "errors": error_names,
+            })
+
+    def get_slowest(self):
+        """Returns (duration, text, stage timings) of the slowest messages,
+        slowest first"""
+        with self.lock:
+            return sorted(self.slowest_messages, reverse=True)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "errors": dict(self.errors),
+                "latencies": dict((key, histogram.summary())
+                                  for key, histogram in self.histograms.items()),
+            }
@@ -0,0 +1,123 @@
+import collections
+import threading
+import time
+
+# MULTIPART MESSAGES
+
+# Concatenated SMS headers number their parts with a single byte
+MAX_PARTS = 255
+
+
+class PendingMessage(object):
+
+    __slots__ = ("sender", "parts", "received", "created")
+
+    def __init__(self, sender, total, created):
+        self.sender = sender
+        self.parts = [None] * total
+        self.received = 0
+        self.created = created
+
+
+class MultipartReassembler(object):
+
+    """Joins the parts of concatenated messages, keyed by sender and the
+    reference number from the message header, and releases a message as
+    soon as its last part arrives.
+
+    Memory is bounded three ways: incomplete messages are dropped ttl
+    seconds after their first part, at most max_pending messages are held
+    (the oldest is dropped first) and a sender can hold at most
+    max_parts_per_sender parts, their oldest message is dropped when a new
+    part would go over.
+    USAGE
+
+    reassembler = MultipartReassembler(ttl=600)
+    result = reassembler.process_part(form, sender, reference, total, number, text)
+    if result is not None:
+        valid, python_fields, errors = result
+    """
+
+    def __init__(self, ttl=600, max_pending=10000, max_parts_per_sender=32,
+                 separator="", clock=time.time):
+        self.ttl = ttl
+        self.max_pending = max_pending
+        self.max_parts_per_sender = max_parts_per_sender
+        self.separator = separator
+        self.clock = clock
+        self.pending = collections.OrderedDict()
+        self.parts_per_sender = collections.Counter()
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def add_part(self, sender, reference, total, number, text):
+        """Adds part number (counting from 1) of total parts and returns the
+        whole text once every part has arrived, None until then"""
+        if not 1 <= number <= total <= MAX_PARTS:
+            raise ValueError("Part {number} of {total} is not a valid part".format(
+                number=number, total=total))
+        if total == 1:
+            return text
+
+        key = (sender, reference)
+        with self.lock:
+            now = self.clock()
+            self.expire(now)
+            message = self.pending.get(key)
+            if message is None:
+                message = self.pending[key] = PendingMessage(sender, total, now)
+            if number > len(message.parts):
+                raise ValueError("Part {number} of {total} does not match the {parts} "
+                                 "parts already received".format(
+                                     number=number, total=total, parts=len(message.parts)))
+            if message.parts[number - 1] is None:
+                message.received += 1
+                self.parts_per_sender[sender] += 1
+            message.parts[number - 1] = text
+
+            if message.received == len(message.parts):
+                self.remove(key)
+                return self.separator.join(message.parts)
+
+            self.enforce_limits(key)
+        return None
+
+    def process_part(self, form, sender, reference, total, number, text):
+        """Adds the part and returns form.process_form of the whole text once
+        it is complete, None until then"""
+        text = self.add_part(sender, reference, total, number, text)
+        if text is None:
+            return None
+        return form.process_form(text)
+
+    def remove(self, key):
+        message = self.pending.pop(key)
+        self.parts_per_sender[message.sender] -= message.received
+        if self.parts_per_sender[message.sender] <= 0:
+            del self.parts_per_sender[message.sender]
+        return message
+
+    def expire(self, now):
+        # Messages are kept in the order their first part came in so expired
+        # messages are always at the front
+        while self.pending:
+            key, message = next(self.pending.iteritems())
+            if now - message.created < self.ttl:
+                break
+            self.remove(key)
+            self.dropped += 1
+
+    def enforce_limits(self, current_key):
+        sender = current_key[0]
+        while self.parts_per_sender[sender] > self.max_parts_per_sender:
+            oldest_key = next(key for key in self.pending if key[0] == sender)
+            self.remove(oldest_key)
+            self.dropped += 1
+            if oldest_key == current_key:
+                break
+        while len(self.pending) > self.max_pending:
+            self.remove(next(iter(self.pending)))
+            self.dropped += 1
+
+    def __len__(self):
+        return len(self.pending)
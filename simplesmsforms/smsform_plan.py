@@ -0,0 +1,61 @@
+import cPickle as pickle
+
+from smsform_binding import FieldBinder
+
+# FORM PLANS
+
+
+class FormPlan(object):
+
+    """Everything a form needs to process messages, computed once when the
+    form is compiled: the fields in order, fields by name, verbose names,
+    the names of required fields and the field binder. A plan can not be
+    changed once built and can be pickled so that workers can load plans
+    instead of compiling their forms again. Fields declared on the form are
+    pickled by reference, a loaded plan uses the form's own field objects.
+    """
+
+    __slots__ = ("form_class", "fields", "attribute_names", "fields_by_name",
+                 "verbose_names", "required", "binder")
+
+    def __init__(self, form_class, fields, attribute_names=None, binder=None):
+        fields = tuple(fields)
+        set_attribute = super(FormPlan, self).__setattr__
+        set_attribute("form_class", form_class)
+        set_attribute("fields", fields)
+        # The class attribute each field is declared as, None for fields that
+        # are not class attributes
+        set_attribute("attribute_names", tuple(attribute_names or [None] * len(fields)))
+        set_attribute("fields_by_name", dict((field.name, field) for field in fields))
+        set_attribute("verbose_names", dict(
+            (field.name, field.get_verbose_name()) for field in fields))
+        set_attribute("required", frozenset(field.name for field in fields if field.required))
+        set_attribute("binder", binder or FieldBinder(fields))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("A FormPlan can not be changed")
+
+    def __getstate__(self):
+        return self.form_class, self.fields, self.attribute_names, self.binder
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def install(self):
+        """Makes this plan the one its form class processes messages with"""
+        self.form_class._plan = self
+
+
+def dump_plans(form_classes, plan_file):
+    """Compiles the form classes and pickles their plans to plan_file"""
+    plans = [form_class().get_plan() for form_class in form_classes]
+    pickle.dump(plans, plan_file, pickle.HIGHEST_PROTOCOL)
+
+
+def load_plans(plan_file):
+    """Loads plans written by dump_plans and installs them on their form
+    classes, returns the plans"""
+    plans = pickle.load(plan_file)
+    for plan in plans:
+        plan.install()
+    return plans
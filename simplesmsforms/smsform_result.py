@@ -0,0 +1,184 @@
+from smsform_exceptions import SMSFieldException
+
+# PARSED MESSAGE
+
+_UNSET = object()
+
+
+class LazyValue(object):
+
+    """A field value that is converted to python, and validated, the first
+    time it is read. Returned by validate_form in "lazy" mode, reading value
+    raises the field's SMSFieldException when the text is not valid.
+    """
+
+    __slots__ = ("field", "text", "prefix", "_value", "_error")
+
+    def __init__(self, field, text, prefix):
+        self.field = field
+        self.text = text
+        self.prefix = prefix
+        self._value = _UNSET
+        self._error = None
+
+    @property
+    def value(self):
+        if self._value is _UNSET:
+            if self._error is None:
+                try:
+                    self._value = self.field.process_field(self.text, self.prefix)
+                except SMSFieldException, e:
+                    self._error = e
+            if self._error is not None:
+                raise self._error
+        return self._value
+
+    @property
+    def converted(self):
+        """True once the value has been read without error"""
+        return self._value is not _UNSET
+
+    def __getstate__(self):
+        return self.field, self.text, self.prefix
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __repr__(self):
+        return "<LazyValue {name}={text!r}>".format(name=self.field.name, text=self.text)
+
+
+def resolve(value):
+    if isinstance(value, LazyValue):
+        return value.value
+    return value
+
+
+class ParsedMessage(object):
+
+    """The result of processing a message with a form. Field names, prefixes
+    and values are held in parallel lists, a name to position index is only
+    built the first time a field is looked up by name.
+
+    For compatibility it also behaves like the (passed_validation,
+    python_fields, errors) tuple process_form used to return, so it can be
+    unpacked, indexed and compared with such a tuple.
+
+    valid is True or False, or None for a "lazy" result that holds
+    LazyValues that were not validated yet. Reading such a value, with get
+    or to_dict, raises the field's exception when it is not valid. Call
+    validate() before handing a lazy result to code that trusts valid, such
+    as a BulkSink.
+    USAGE
+
+    result = form.process_form("REG fnAndre lnLesa ag12 locLusaka")
+    if result.valid:
+        age = result.get("age")
+    """
+
+    __slots__ = ("valid", "names", "prefixes", "values", "errors", "duplicate",
+                 "_positions")
+
+    def __init__(self, valid, names, prefixes, values, errors, duplicate=False):
+        self.valid = valid
+        self.names = names
+        self.prefixes = prefixes
+        self.values = values
+        self.errors = errors
+        # True when the result is for a message that was already processed
+        self.duplicate = duplicate
+        self._positions = None
+
+    def copy(self, duplicate=False):
+        """Returns a copy whose lists, including list values, are its own, so
+        changing one does not change the other"""
+        values = [list(value) if isinstance(value, list) else value for value in self.values]
+        return ParsedMessage(self.valid, list(self.names), list(self.prefixes), values,
+                             list(self.errors), duplicate=duplicate)
+
+    def as_duplicate(self):
+        """Returns a copy flagged as a duplicate"""
+        return self.copy(duplicate=True)
+
+    def validate(self):
+        """Converts the LazyValues of a lazy result, setting valid and adding
+        the errors of the values that are not valid. Returns the result"""
+        if self.valid is not None:
+            return self
+        valid = True
+        for position, value in enumerate(self.values):
+            try:
+                self.values[position] = resolve(value)
+            except SMSFieldException, e:
+                self.errors.append(e)
+                valid = False
+        self.valid = valid
+        return self
+
+    def position(self, name):
+        if self._positions is None:
+            self._positions = dict((field_name, position)
+                                   for position, field_name in enumerate(self.names))
+        return self._positions[name]
+
+    def get(self, name, default=None):
+        """Returns the python value of the named field, lazy values are
+        converted here"""
+        try:
+            return resolve(self.values[self.position(name)])
+        except KeyError:
+            return default
+
+    def get_prefix(self, name, default=None):
+        """Returns the prefix the named field was sent with"""
+        try:
+            return self.prefixes[self.position(name)]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        try:
+            self.position(name)
+        except KeyError:
+            return False
+        return True
+
+    def to_dict(self):
+        return dict(zip(self.names, [resolve(value) for value in self.values]))
+
+    @property
+    def python_fields(self):
+        """The fields as a tuple of (field name, (prefix, value))"""
+        return tuple(zip(self.names, zip(self.prefixes, self.values)))
+
+    def as_tuple(self):
+        return self.valid, self.python_fields, self.errors
+
+    def __iter__(self):
+        return iter(self.as_tuple())
+
+    def __len__(self):
+        return 3
+
+    def __getitem__(self, index):
+        return self.as_tuple()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, ParsedMessage):
+            other = other.as_tuple()
+        return self.as_tuple() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return self.valid, self.names, self.prefixes, self.values, self.errors, self.duplicate
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __repr__(self):
+        return "<ParsedMessage valid={valid} {fields}>".format(
+            valid=self.valid, fields=dict(zip(self.names, self.values)))
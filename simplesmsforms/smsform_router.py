@@ -0,0 +1,97 @@
+from smsform_exceptions import UnknownKeywordException
+from smsform_fuzzy import BKTree
+
+# FORM ROUTER
+
+
+def normalize_keyword(keyword):
+    return keyword.strip().lower()
+
+
+class FormRouter(object):
+
+    """Indexes SMSForm classes by their keyword and aliases so an incoming
+    message is handed to its form with a single dict lookup. Keywords that
+    are not registered are corrected to the closest registered keyword within
+    max_distance edits. When the sender is given, a message without a
+    registered keyword first goes to the form the sender has an open session
+    with, see SessionStore.
+    USAGE
+
+    router = FormRouter([PersonForm, MotherForm])
+    form, (valid, fields, errors) = router.dispatch("REG fnAndre lnLesa")
+    """
+
+    def __init__(self, form_classes=(), max_distance=1):
+        self.max_distance = max_distance
+        self.forms = {}
+        self.session_forms = []
+        self.keyword_tree = BKTree()
+        for form_class in form_classes:
+            self.register(form_class)
+
+    def get_keywords(self, form_class):
+        keywords = [form_class.keyword] + list(getattr(form_class, "aliases", ()))
+        return [normalize_keyword(keyword) for keyword in keywords if keyword]
+
+    def register(self, form_class):
+        """Registers a form class under its keyword and aliases, a keyword can
+        only belong to one form"""
+        keywords = self.get_keywords(form_class)
+        if not keywords:
+            raise ValueError("{form} has no keyword to route on".format(
+                form=form_class.__name__))
+        for keyword in keywords:
+            registered = self.forms.get(keyword)
+            if registered is not None and type(registered) is not form_class:
+                raise ValueError("The keyword '{keyword}' is already used by {form}".format(
+                    keyword=keyword, form=type(registered).__name__))
+
+        form = form_class()
+        for keyword in keywords:
+            self.forms[keyword] = form
+            self.keyword_tree.add(keyword)
+        if form.session_store is not None:
+            self.session_forms.append(form)
+        return form
+
+    def get_keyword(self, text):
+        tokens = text.split(None, 1)
+        return normalize_keyword(tokens[0]) if tokens else ""
+
+    def route(self, text, sender=None):
+        """Returns the form that should process the passed in text"""
+        keyword = self.get_keyword(text)
+        form = self.forms.get(keyword)
+        if form is not None:
+            return form
+        if sender is not None:
+            form = self.route_session(sender)
+            if form is not None:
+                return form
+
+        if self.max_distance:
+            found = self.keyword_tree.search(keyword, self.max_distance)
+            # Keywords tied for closest must all belong to the same form
+            closest_forms = set(
+                self.forms[corrected_keyword] for distance, corrected_keyword in found
+                if distance == found[0][0])
+            if len(closest_forms) == 1:
+                return closest_forms.pop()
+        raise UnknownKeywordException(keyword)
+
+    def route_session(self, sender):
+        """Returns the form the sender most recently updated an open session
+        with, None when there is no open session"""
+        latest = None
+        for form in self.session_forms:
+            updated = form.session_store.get_updated(form, sender)
+            if updated is not None and (latest is None or updated > latest[0]):
+                latest = (updated, form)
+        return latest[1] if latest is not None else None
+
+    def dispatch(self, text, sender=None):
+        """Processes the text with the form its keyword routes to and returns
+        (form, process_form result)"""
+        form = self.route(text, sender)
+        return form, form.process_form(text, sender=sender)
@@ -0,0 +1,225 @@
+import hashlib
+import json
+import os
+import threading
+
+from smsform import SMSForm
+from smsform_fields import (PrefixField, MultiChoiceField, SingleChoiceField, DateField,
+                            IntegerField, DecimalField)
+from smsform_instrumentation import timer
+from smsform_router import FormRouter
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# FORM SCHEMAS
+
+FIELD_TYPES = {
+    "prefix": PrefixField,
+    "multi_choice": MultiChoiceField,
+    "single_choice": SingleChoiceField,
+    "date": DateField,
+    "integer": IntegerField,
+    "decimal": DecimalField,
+}
+
+# The options a schema field of each type can set, validators are python
+# callables and can not be set from a schema
+FIELD_OPTIONS = ("name", "type", "prefixes", "required", "memo_size")
+CHOICE_OPTIONS = FIELD_OPTIONS + ("choices", "choice_divider", "fuzzy", "max_distance")
+NUMBER_OPTIONS = FIELD_OPTIONS + ("units", "min_value", "max_value")
+FIELD_TYPE_OPTIONS = {
+    "prefix": FIELD_OPTIONS,
+    "multi_choice": CHOICE_OPTIONS,
+    "single_choice": CHOICE_OPTIONS,
+    "date": FIELD_OPTIONS + ("date_formats", "cache_size"),
+    "integer": NUMBER_OPTIONS,
+    "decimal": NUMBER_OPTIONS,
+}
+# Options that must be lists, a string would be taken as a list of its
+# characters
+LIST_OPTIONS = ("prefixes", "choices", "date_formats")
+
+# The form attributes a schema can set
+FORM_OPTIONS = ("keyword", "aliases", "binding", "blank_field", "max_message_length",
+                "time_budget")
+
+
+def load_schema(path):
+    """Reads a JSON or, when PyYAML is installed, YAML schema file"""
+    with open(path) as schema_file:
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise ValueError("PyYAML is needed to load {path}".format(path=path))
+            return yaml.safe_load(schema_file)
+        return json.load(schema_file)
+
+
+def hash_definition(definition):
+    return hashlib.sha1(json.dumps(definition, sort_keys=True)).hexdigest()
+
+
+def build_field(form_name, definition):
+    options = dict((str(key), value) for key, value in definition.items())
+    field_type = options.pop("type", "prefix")
+    field_class = FIELD_TYPES.get(field_type)
+    if field_class is None:
+        raise ValueError("{form}: field {field} has unknown type '{type}', expected one of "
+                         "{types}".format(form=form_name, field=options.get("name"),
+                                          type=field_type, types=", ".join(sorted(FIELD_TYPES))))
+    if not options.get("name"):
+        raise ValueError("{form}: every field needs a name".format(form=form_name))
+    unknown = set(options) - set(FIELD_TYPE_OPTIONS[field_type])
+    if unknown:
+        raise ValueError("{form}: field {field} has unknown options {options}".format(
+            form=form_name, field=options["name"], options=", ".join(sorted(unknown))))
+    for option in LIST_OPTIONS:
+        if option in options and not isinstance(options[option], list):
+            raise ValueError("{form}: {option} of field {field} must be a list".format(
+                form=form_name, option=option, field=options["name"]))
+    if "units" in options and not isinstance(options["units"], (list, dict)):
+        raise ValueError("{form}: units of field {field} must be a list or a mapping".format(
+            form=form_name, field=options["name"]))
+    return field_class(**options)
+
+
+def build_form(definition, base_class=SMSForm):
+    """Builds a form class from a schema definition:
+
+    {"name": "PersonForm", "keyword": "REG",
+     "fields": [{"name": "first_name", "prefixes": ["fn"]},
+                {"name": "gender", "type": "single_choice", "choices": ["m", "f"]},
+                {"name": "date", "type": "date", "prefixes": ["dt"], "required": false}]}
+
+    The field options are the keyword arguments of the field class named by
+    type, prefix when left out, see FIELD_TYPE_OPTIONS. Unknown options and
+    prefixes, choices or date_formats that are not lists raise a
+    ValueError."""
+    form_name = definition.get("name")
+    if not form_name:
+        raise ValueError("Every form in the schema needs a name")
+    unknown = set(definition) - set(FORM_OPTIONS) - set(["name", "fields"])
+    if unknown:
+        raise ValueError("{form}: unknown form options {options}".format(
+            form=form_name, options=", ".join(sorted(unknown))))
+
+    attrs = dict((str(option), definition[option]) for option in FORM_OPTIONS
+                 if option in definition)
+    if "aliases" in attrs:
+        attrs["aliases"] = tuple(attrs["aliases"])
+    for field_definition in definition.get("fields", ()):
+        field = build_field(form_name, field_definition)
+        attrs[str(field.name)] = field
+    return type(str(form_name), (base_class,), attrs)
+
+
+class SchemaLoader(object):
+
+    """Builds form classes from a schema file and routes messages to them,
+    rebuilding the forms when the file changes. Only forms whose definition
+    changed are built again, the others keep their class and its warm
+    caches.
+
+    A reload builds a new FormRouter and swaps it in under a lock. Messages
+    that were already routed finish on the form they were routed to, later
+    messages get the new forms. last_swap_latency is the time in seconds from
+    noticing the change to the swap, on_reload, when given, is called with
+    the loader, the names of the rebuilt forms and that latency.
+    USAGE
+
+    loader = SchemaLoader("forms.json")
+    loader.watch(poll_interval=2)
+    form, result = loader.dispatch(text, sender)
+    """
+
+    def __init__(self, path, base_class=SMSForm, max_distance=1, on_reload=None):
+        self.path = path
+        self.base_class = base_class
+        self.max_distance = max_distance
+        self.on_reload = on_reload
+        # Form name mapped to (definition hash, form class)
+        self.built = {}
+        self.router = None
+        self.mtime = None
+        self.last_swap_latency = None
+        self.last_error = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.watcher = None
+        self.reload()
+
+    @property
+    def form_classes(self):
+        return dict((name, form_class) for name, (digest, form_class) in self.built.items())
+
+    def get_mtime(self):
+        return os.stat(self.path).st_mtime
+
+    def reload(self):
+        """Reads the schema and swaps in the forms, returns the names of the
+        forms that were rebuilt"""
+        with self.lock:
+            start = timer()
+            self.mtime = self.get_mtime()
+            schema = load_schema(self.path)
+            built = {}
+            rebuilt = []
+            for definition in schema.get("forms", ()):
+                digest = hash_definition(definition)
+                name = definition.get("name")
+                if name in built:
+                    raise ValueError("The form {form} is defined twice".format(form=name))
+                previous = self.built.get(name)
+                if previous is not None and previous[0] == digest:
+                    built[name] = previous
+                    continue
+                built[name] = (digest, build_form(definition, self.base_class))
+                rebuilt.append(name)
+
+            router = FormRouter([form_class for digest, form_class in built.values()],
+                                max_distance=self.max_distance)
+            self.built = built
+            self.router = router
+            self.last_swap_latency = timer() - start
+        if self.on_reload is not None:
+            self.on_reload(self, rebuilt, self.last_swap_latency)
+        return rebuilt
+
+    def check(self):
+        """Reloads the schema if the file changed since it was last loaded,
+        returns the names of the rebuilt forms"""
+        if self.get_mtime() == self.mtime:
+            return []
+        return self.reload()
+
+    def watch(self, poll_interval=1.0):
+        """Checks the schema every poll_interval seconds in a daemon thread.
+        A schema that can not be loaded leaves the current forms in place and
+        is kept as last_error"""
+        def poll():
+            while not self.stopped.wait(poll_interval):
+                try:
+                    self.check()
+                    self.last_error = None
+                except Exception, e:
+                    self.last_error = e
+        self.stopped.clear()
+        self.watcher = threading.Thread(target=poll)
+        self.watcher.daemon = True
+        self.watcher.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.watcher is not None:
+            self.watcher.join()
+            self.watcher = None
+
+    def route(self, text, sender=None):
+        return self.router.route(text, sender)
+
+    def dispatch(self, text, sender=None):
+        """Processes the text with the form its keyword routes to and returns
+        (form, process_form result)"""
+        return self.router.dispatch(text, sender=sender)
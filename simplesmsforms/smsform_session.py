@@ -0,0 +1,104 @@
+import threading
+import time
+
+from smsform_binding import tokenize
+from smsform_cache import MemoryResultBackend
+
+# SESSIONS
+
+
+def starts_with_keyword(form, tokens):
+    keywords = [keyword.lower() for keyword in (form.keyword,) + tuple(form.aliases)]
+    return bool(tokens) and tokens[0].lower() in keywords
+
+
+class SessionStore(object):
+
+    """Keeps the fields of a sender's last invalid message so that a follow
+    up message only has to send what was missing or invalid. A follow up is
+    a message without the form keyword, its tokens are bound to the fields
+    the session does not hold yet and the merged fields are validated again.
+    A message that starts with the keyword starts a new session.
+
+    Sessions are kept for ttl seconds after the last message and dropped once
+    the form is valid. Only the raw (prefix, value) text of fields that
+    passed validation is kept, a session holding more than max_session_size
+    characters is not kept at all. The backend is one of the result
+    backends from smsform_cache or any object with get(key, now),
+    set(key, value, expires) and delete(key).
+    USAGE
+
+    PersonForm.session_store = SessionStore(ttl=900)
+    form = PersonForm()
+    form.process_form("REG fnAndre lnLesa ag12", sender="+260971000000")
+    result = form.process_form("locLusaka", sender="+260971000000")
+    """
+
+    def __init__(self, backend=None, ttl=900, max_session_size=1024, clock=time.time):
+        self.backend = backend if backend is not None else MemoryResultBackend()
+        self.ttl = ttl
+        self.max_session_size = max_session_size
+        self.clock = clock
+        self.continued = 0
+        self.lock = threading.Lock()
+
+    def get_key(self, form, sender):
+        return u"\x00".join([u"session", form.keyword.lower(), unicode(sender)])
+
+    def get_updated(self, form, sender):
+        """Returns the time the sender's open session with form was last
+        updated, None when there is no open session"""
+        session = self.backend.get(self.get_key(form, sender), self.clock())
+        if session is None:
+            return None
+        return session[0]
+
+    def continues(self, form, sender, text):
+        """Returns True when text is a follow up to an open session of the
+        sender, its result then depends on the session and not only on text"""
+        if starts_with_keyword(form, tokenize(text)):
+            return False
+        return self.backend.get(self.get_key(form, sender), self.clock()) is not None
+
+    def process(self, form, sender, text):
+        """Processes text as a new message or as a follow up to the sender's
+        session and returns the ParsedMessage of the merged fields"""
+        deadline = form.get_deadline()
+        key = self.get_key(form, sender)
+        now = self.clock()
+        tokens = tokenize(text)
+        session = self.backend.get(key, now)
+        if session is None or starts_with_keyword(form, tokens):
+            bound_fields = form.bind_fields(text)
+        else:
+            bound_fields = self.continue_session(form, session[1], tokens)
+            with self.lock:
+                self.continued += 1
+
+        result = form.make_result(*form.validate_form(bound_fields, deadline=deadline))
+        self.save(key, result, bound_fields, now)
+        return result
+
+    def continue_session(self, form, fields, tokens):
+        plan = form.get_plan()
+        kept = tuple((plan.fields_by_name[name], (prefix, value))
+                     for name, prefix, value in fields if name in plan.fields_by_name)
+        kept_fields = set(field for field, bound in kept)
+        missing = [field for field in plan.fields if field not in kept_fields]
+        return kept + form.get_binder().bind(tokens, missing)
+
+    def save(self, key, result, bound_fields, now):
+        if result.valid:
+            self.backend.delete(key)
+            return
+        # Fields that failed validation are left out so the follow up can
+        # send them again
+        valid_names = set(result.names)
+        fields = tuple((field.name, prefix, value) for field, (prefix, value) in bound_fields
+                       if field.name in valid_names)
+        size = sum(len(name) + len(prefix) + len(value or "") for name, prefix, value in fields)
+        if not fields or size > self.max_session_size:
+            self.backend.delete(key)
+            return
+        # A session is stored as (last updated, fields)
+        self.backend.set(key, (now, fields), now + self.ttl)
@@ -0,0 +1,161 @@
+import decimal
+import threading
+import time
+import Queue
+
+# RESULT SINKS
+
+PLACEHOLDERS = {
+    "qmark": lambda position: "?",
+    "format": lambda position: "%s",
+    "pyformat": lambda position: "%s",
+    "numeric": lambda position: ":{position}".format(position=position),
+}
+
+_STOP = object()
+
+
+def to_column_value(value):
+    if isinstance(value, list):
+        return ",".join(value)
+    if isinstance(value, decimal.Decimal):
+        # Not every driver can bind a Decimal, its string keeps every digit
+        return str(value)
+    return value
+
+
+class BulkSink(object):
+
+    """Writes processed messages to a DB-API database in batches. The values
+    of valid results are collected column by column and inserted into table
+    with executemany, one transaction per batch. Invalid results go to
+    error_table as (text, errors) rows when an error_table is given.
+
+    A batch is written once batch_size results are waiting or flush_interval
+    seconds after the last write. By default that happens in add(), with
+    threaded=True a writer thread does it and add() blocks while max_queue
+    results are waiting to be written. A connection used from the writer
+    thread must allow it, for sqlite3 that means check_same_thread=False.
+    USAGE
+
+    sink = BulkSink(connection, "people", ["first_name", "last_name", "age"],
+                    error_table="rejected")
+    for text in texts:
+        sink.add(form.process_form(text), text)
+    sink.close()
+    """
+
+    def __init__(self, connection, table, columns, error_table=None, batch_size=500,
+                 flush_interval=5.0, threaded=False, max_queue=10000,
+                 paramstyle="qmark", clock=time.time):
+        self.connection = connection
+        self.columns = list(columns)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.last_flush = clock()
+        self.written = 0
+        self.errors_written = 0
+
+        placeholder = PLACEHOLDERS[paramstyle]
+        self.insert_sql = "INSERT INTO {table} ({columns}) VALUES ({values})".format(
+            table=table, columns=", ".join(self.columns),
+            values=", ".join(placeholder(position) for position in range(1, len(self.columns) + 1)))
+        self.error_sql = None
+        if error_table is not None:
+            self.error_sql = "INSERT INTO {table} (text, errors) VALUES ({values})".format(
+                table=error_table, values=", ".join(placeholder(position) for position in (1, 2)))
+        self.reset_batch()
+
+        self.queue = None
+        self.writer = None
+        self.writer_error = None
+        if threaded:
+            self.queue = Queue.Queue(max_queue)
+            self.writer = threading.Thread(target=self.write_queued)
+            self.writer.daemon = True
+            self.writer.start()
+
+    def reset_batch(self):
+        self.batch = [[] for _ in self.columns]
+        self.batch_length = 0
+        self.error_rows = []
+
+    def add(self, result, text=None):
+        """Adds a process_form result, text is what is stored for invalid
+        results. Lazy results that were not validated are refused"""
+        if result.valid is None:
+            raise ValueError("Lazy results must be validated before they are added to a sink, "
+                             "see ParsedMessage.validate")
+        if self.queue is None:
+            self.collect(result, text)
+            self.flush_if_due()
+            return
+        if self.writer_error is not None:
+            raise self.writer_error
+        self.queue.put((result, text))
+
+    def collect(self, result, text):
+        if result.valid:
+            for column_values, column in zip(self.batch, self.columns):
+                column_values.append(to_column_value(result.get(column)))
+            self.batch_length += 1
+        elif self.error_sql is not None:
+            self.error_rows.append((text, "; ".join(str(error) for error in result.errors)))
+
+    def flush_if_due(self):
+        waiting = self.batch_length + len(self.error_rows)
+        if waiting >= self.batch_size or \
+                (waiting and self.clock() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Writes the collected results in one transaction"""
+        self.last_flush = self.clock()
+        if not self.batch_length and not self.error_rows:
+            return
+        cursor = self.connection.cursor()
+        try:
+            if self.batch_length:
+                cursor.executemany(self.insert_sql, zip(*self.batch))
+            if self.error_rows:
+                cursor.executemany(self.error_sql, self.error_rows)
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        finally:
+            cursor.close()
+        self.written += self.batch_length
+        self.errors_written += len(self.error_rows)
+        self.reset_batch()
+
+    def write_queued(self):
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.flush_interval)
+                except Queue.Empty:
+                    self.flush_if_due()
+                    continue
+                if item is _STOP:
+                    self.flush()
+                    return
+                self.collect(*item)
+                self.flush_if_due()
+        except Exception, e:
+            self.writer_error = e
+            # Keep taking items so add() does not block forever
+            while self.queue.get() is not _STOP:
+                pass
+
+    def close(self):
+        """Writes everything that is still waiting"""
+        if self.writer is not None:
+            self.queue.put(_STOP)
+            self.writer.join()
+            self.writer = None
+            if self.writer_error is not None:
+                raise self.writer_error
+        else:
+            self.flush()
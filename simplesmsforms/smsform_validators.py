@@ -17,21 +17,22 @@ def lowercase_list_util(value_list):
 
 def multiple_choice_validator(*args, **kwargs):
     """Takes a single value or a list of values and validates that they are all
-    part of a set of choices"""
+    part of a set of choices, choice_index can be passed as a precomputed set
+    of the lower cased choices"""
     value = set(lowercase_list_util(kwargs["value"]))
-    choices = set(lowercase_list_util(kwargs["choices"]))
+    choices = kwargs.get("choice_index") or set(lowercase_list_util(kwargs["choices"]))
     if not value.issubset(choices):
         raise ChoiceException("Invalid option '{value}', please select one of: {choices_string}".format(
                 value=", ".join(value),
-                choices_string=", ".join(choices)))
+                choices_string=", ".join(kwargs["choices"])))
 
 def single_choice_validator(*args, **kwargs):
     """Takes a value and validates that it is atleast one of some number of
     variables"""
-    multiple_choice_validator(*args, **kwargs)
-
     value = kwargs.get("value")
     choices = kwargs.get("choices")
     if len(value) > 1:
         raise ChoiceException("Please select only one value out of {choices_string}".format(
-            choices_string=", ".join(choices)))
\ No newline at end of file
+            choices_string=", ".join(choices)))
+
+    multiple_choice_validator(*args, **kwargs)
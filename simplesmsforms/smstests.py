@@ -1,10 +1,35 @@
 import re
 import datetime
 import unittest
+import warnings
+import decimal
+import multiprocessing.pool
+import time
+import sys
+import smsform_fields
 from smsform_fields import (GenericSMSField, PrefixField, SingleChoiceField,
-                            MultiChoiceField, DateField)
+                            MultiChoiceField, DateField, IntegerField, DecimalField)
 from smsform_exceptions import (ChoiceException, InvalidDateException,
-                                MissingRequiredFieldException)
+                                MissingRequiredFieldException, AmbiguousPrefixWarning,
+                                UnknownKeywordException, InvalidNumberException,
+                                NumberRangeException, MessageTooLongException,
+                                MessageTimeoutException)
+from smsform_binding import FieldBinder
+from smsform_fuzzy import BKTree, edit_distance
+from smsform_router import FormRouter
+from smsform_ingest import FormIngestor
+from smsform_dates import DateParser
+from smsform_result import ParsedMessage, LazyValue
+import smsform_benchmark
+from smsform_instrumentation import Instrumentation
+from smsform_plan import FormPlan, dump_plans, load_plans
+from smsform_multipart import MultipartReassembler
+from smsform_cache import (ResultCache, MemoryResultBackend, SQLiteResultBackend,
+                           estimate_size)
+import smsform_cli
+from smsform_sink import BulkSink
+from smsform_session import SessionStore
+from smsform_schema import SchemaLoader
 from smsform import SMSForm
 
 
@@ -58,6 +83,19 @@ class TestSMSForms(unittest.TestCase):
         self.assertFalse(valid)
         self.assertIsInstance(errors[0], MissingRequiredFieldException)
 
+    def test_empty_message(self):
+        valid, python_fields, errors = self.person_form.process_form("")
+        self.assertFalse(valid)
+        self.assertEqual(len(errors), 4)
+        self.assertTrue(all(isinstance(error, MissingRequiredFieldException) for error in errors))
+
+    def test_whitespace_separators(self):
+        for text in ["REG\nfnAndre\nlnLesa\nag12\nlocLusaka",
+                     "REG fnAndre\tlnLesa  ag12\r\nlocLusaka"]:
+            result = self.person_form.process_form(text)
+            self.assertTrue(result.valid)
+            self.assertEqual(result.get("last_name"), "Lesa")
+
     def test_form_validation_date(self):
         bound_fields = self.expected_bound_fields + (
             (self.person_form.date, ("dt", "12jan15")),
@@ -103,6 +141,1149 @@ class TestSMSForms(unittest.TestCase):
         for exception in process_form_result[2]:
             self.assertIsInstance(exception, MissingRequiredFieldException)
 
+class TestParsedMessage(unittest.TestCase):
+
+    def setUp(self):
+        self.result = PersonForm().process_form("REG fnAndre lnLesa ag12 locLusaka")
+
+    def test_field_access(self):
+        self.assertIsInstance(self.result, ParsedMessage)
+        self.assertTrue(self.result.valid)
+        self.assertEqual(self.result.get("age"), "12")
+        self.assertEqual(self.result.get_prefix("location"), "loc")
+        self.assertEqual(self.result.get("date", "none"), "none")
+        self.assertTrue("first_name" in self.result)
+        self.assertFalse("date" in self.result)
+        self.assertEqual(self.result.to_dict()["last_name"], "Lesa")
+
+    def test_legacy_tuple_view(self):
+        valid, python_fields, errors = self.result
+        self.assertEqual(self.result.as_tuple(), (valid, python_fields, errors))
+        self.assertEqual(self.result[1][0], ("first_name", ("fn", "Andre")))
+        self.assertEqual(len(self.result), 3)
+
+    def test_pickle(self):
+        import pickle
+        result = PersonForm().process_form("REG lnLesa ag12 locLusaka")
+        unpickled = pickle.loads(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(unpickled.python_fields, result.python_fields)
+        self.assertIsInstance(unpickled.errors[0], MissingRequiredFieldException)
+
+
+class TestFieldBinder(unittest.TestCase):
+
+    def test_longest_prefix_wins(self):
+        l_field = PrefixField(prefixes=["l"], name="l_field")
+        last_name = PrefixField(prefixes=["ln"], name="last_name")
+        location = PrefixField(prefixes=["loc"], name="location")
+        binder = FieldBinder([l_field, last_name, location])
+
+        bound_fields = binder.bind(["lnLesa", "locLusaka", "lx"])
+        self.assertEqual(bound_fields, (
+            (l_field, ("l", "x")),
+            (last_name, ("ln", "Lesa")),
+            (location, ("loc", "Lusaka")),
+        ))
+
+    def test_ambiguous_prefixes(self):
+        l_field = PrefixField(prefixes=["l"], name="l_field")
+        last_name = PrefixField(prefixes=["ln"], name="last_name")
+        location = PrefixField(prefixes=["loc"], name="location")
+        binder = FieldBinder([l_field, last_name, location])
+
+        self.assertEqual(binder.ambiguous_prefixes, [
+            ("l", "l_field", "ln", "last_name"),
+            ("l", "l_field", "loc", "location"),
+        ])
+        self.assertEqual(FieldBinder(PersonForm().get_fields()).ambiguous_prefixes, [])
+
+    def test_ambiguous_prefix_warning(self):
+        class AmbiguousForm(SMSForm):
+            keyword = "AMB"
+            l_field = PrefixField(prefixes=["l"], name="l_field")
+            last_name = PrefixField(prefixes=["ln"], name="last_name")
+
+            def get_fields(self):
+                return [self.l_field, self.last_name]
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            AmbiguousForm().bind_fields("AMB lnLesa")
+            AmbiguousForm().bind_fields("AMB lnLesa")
+        self.assertEqual(len(caught), 1)
+        self.assertTrue(issubclass(caught[0].category, AmbiguousPrefixWarning))
+
+    def test_ambiguous_prefix_warning_on_declaration(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+
+            class AmbiguousForm(SMSForm):
+                keyword = "AMB"
+                l_field = PrefixField(prefixes=["l"])
+                last_name = PrefixField(prefixes=["ln"])
+
+            self.assertEqual(len(caught), 1)
+            self.assertTrue(issubclass(caught[0].category, AmbiguousPrefixWarning))
+            self.assertIn("l_field", str(caught[0].message))
+            # The warning needs no compiled plan
+            self.assertIsNone(AmbiguousForm.__dict__.get("_plan"))
+            AmbiguousForm().bind_fields("AMB lnLesa")
+        self.assertEqual(len(caught), 1)
+
+    def test_pattern_fields_bind_unprefixed_tokens(self):
+        form = PersonForm()
+        bound_fields = form.bind_fields("REG fnAndre 12jan15 LNLesa")
+        self.assertEqual(bound_fields, (
+            (form.first_name, ("fn", "Andre")),
+            (form.last_name, ("ln", "Lesa")),
+            (form.date, ("", "12jan15")),
+        ))
+
+
+class ReportForm(SMSForm):
+    keyword = "STOCK"
+    aliases = ("stk",)
+
+    item = PrefixField(prefixes=["it"], name="item")
+
+    def get_fields(self):
+        return [self.item]
+
+
+class TestFormRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.router = FormRouter([PersonForm, ReportForm])
+
+    def test_dispatch(self):
+        form, (valid, python_fields, errors) = self.router.dispatch(
+            "reg fnAndre lnLesa ag12 locLusaka")
+        self.assertIsInstance(form, PersonForm)
+        self.assertTrue(valid)
+
+    def test_alias(self):
+        self.assertIsInstance(self.router.route("STK itsoap"), ReportForm)
+        self.assertIsInstance(self.router.route("stk\titsoap"), ReportForm)
+        with self.assertRaises(UnknownKeywordException):
+            self.router.route("")
+
+    def test_misspelled_keyword(self):
+        self.assertIsInstance(self.router.route("STOK itsoap"), ReportForm)
+        self.assertIsInstance(self.router.route("REGG fnAndre"), PersonForm)
+        with self.assertRaises(UnknownKeywordException):
+            self.router.route("HELLO there")
+
+    def test_session_follow_up(self):
+        class SessionPersonForm(PersonForm):
+            session_store = SessionStore()
+
+        class SessionReportForm(ReportForm):
+            aliases = ("stk", "ag1")
+            session_store = SessionStore()
+
+        router = FormRouter([SessionPersonForm, SessionReportForm])
+        self.assertFalse(router.dispatch("REG fnAndre lnLesa locLusaka", sender="+260971")[1].valid)
+        with self.assertRaises(UnknownKeywordException):
+            router.dispatch("locLusaka", sender="+260972")
+        # Without the session "ag12" is one edit from the "ag1" alias
+        self.assertIsInstance(router.route("ag12", sender="+260972"), SessionReportForm)
+
+        form, result = router.dispatch("ag12", sender="+260971")
+        self.assertIsInstance(form, SessionPersonForm)
+        self.assertTrue(result.valid)
+        self.assertEqual(result.get("first_name"), "Andre")
+
+    def test_duplicate_keyword(self):
+        class OtherForm(SMSForm):
+            keyword = "reg"
+        with self.assertRaises(ValueError):
+            self.router.register(OtherForm)
+
+    def test_bktree(self):
+        self.assertEqual(edit_distance("offcer", "officer"), 1)
+        tree = BKTree(["clerk", "officer", "supervisor", "director"])
+        self.assertEqual(tree.search("offcer", 1), [(1, "officer")])
+        self.assertEqual(tree.closest("manager", 2), None)
+
+
+class TestProcessMany(unittest.TestCase):
+
+    def setUp(self):
+        self.person_form = PersonForm()
+        self.texts = [
+            "REG fnAndre lnLesa ag12 locLusaka",
+            "REG lnLesa ag12 locLusaka",
+            "REG fnJane lnBanda ag30 locNdola 12jan15",
+        ] * 5
+
+    def test_process_many_inline(self):
+        results = list(self.person_form.process_many(self.texts))
+        self.assertEqual([index for index, result in results], range(len(self.texts)))
+        self.assertEqual(results[1][1][:2], self.person_form.process_form(self.texts[1])[:2])
+
+    def test_process_many_pool(self):
+        results = list(self.person_form.process_many(self.texts, workers=2, chunksize=2))
+        for index, (valid, python_fields, errors) in results:
+            expected = self.person_form.process_form(self.texts[index])
+            self.assertEqual((valid, python_fields), expected[:2])
+            self.assertEqual(valid, index % 3 != 1)
+        self.assertEqual([index for index, result in results], range(len(self.texts)))
+
+    def test_pool_input_is_bounded(self):
+        read = [0]
+
+        def texts():
+            for text in self.texts * 100:
+                read[0] += 1
+                yield text
+
+        results = self.person_form.process_many(texts(), workers=2, chunksize=1)
+        next(results)
+        time.sleep(0.2)
+        # Eight chunks in flight, one taken and one waiting for a slot
+        self.assertLessEqual(read[0], 10)
+        self.assertEqual(len(list(results)), len(self.texts) * 100 - 1)
+
+    def test_pool_input_error(self):
+        def texts():
+            yield "REG fnAndre"
+            raise IOError("input went away")
+
+        with self.assertRaises(IOError):
+            list(self.person_form.process_many(texts(), workers=2, chunksize=1))
+
+    def test_pool_worker_settings(self):
+        form = PersonForm()
+        form.max_message_length = 20
+        results = list(form.process_many(self.texts, workers=2, chunksize=2))
+        self.assertIsInstance(results[0][1].errors[0], MessageTooLongException)
+
+        form.instrumentation = Instrumentation()
+        with self.assertRaises(ValueError):
+            list(form.process_many(self.texts, workers=2))
+
+        class InstrumentedForm(PersonForm):
+            instrumentation = Instrumentation()
+        with self.assertRaises(ValueError):
+            list(InstrumentedForm().process_many(self.texts, workers=2))
+
+    def test_process_many_threaded(self):
+        results = list(self.person_form.process_many_threaded(
+            self.texts * 10, workers=4, chunksize=3))
+        self.assertEqual([index for index, result in results], range(len(self.texts) * 10))
+        for index, result in results:
+            self.assertEqual(result.valid, index % 3 != 1)
+            if result.valid:
+                self.assertEqual(result.get_prefix("first_name"), "fn")
+
+    def test_process_many_unordered(self):
+        results = list(self.person_form.process_many(
+            self.texts, workers=2, chunksize=4, ordered=False))
+        self.assertEqual(sorted(index for index, result in results), range(len(self.texts)))
+
+
+class TestFormIngestor(unittest.TestCase):
+
+    def setUp(self):
+        self.ingestor = FormIngestor(PersonForm(), max_queue=4, workers=2, batch_size=3)
+
+    def tearDown(self):
+        self.ingestor.close()
+
+    def test_submit(self):
+        pending = self.ingestor.submit("REG fnAndre lnLesa ag12 locLusaka")
+        valid, python_fields, errors = pending.result(timeout=5)
+        self.assertTrue(valid)
+        self.assertEqual(python_fields[0], ("first_name", ("fn", "Andre")))
+
+    def test_stream_keeps_order(self):
+        texts = ["REG fnAndre lnLesa ag{age} locLusaka".format(age=age) for age in range(50)]
+        results = list(self.ingestor.stream(texts))
+        self.assertEqual(
+            [python_fields[2][1][1] for valid, python_fields, errors in results],
+            [str(age) for age in range(50)])
+        self.ingestor.close()
+        self.assertEqual(self.ingestor.queue_depth, 0)
+        self.assertEqual(self.ingestor.in_flight, 0)
+        self.assertEqual(self.ingestor.processed, 50)
+
+    def test_done_callback(self):
+        results = []
+        pending = self.ingestor.submit("REG lnLesa")
+        pending.add_done_callback(lambda done: results.append(done.result()))
+        pending.result(timeout=5)
+        self.ingestor.close()
+        self.assertFalse(results[0][0])
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_corpus(self):
+        form_class = smsform_benchmark.build_form(field_count=4, choice_count=10)
+        corpus = smsform_benchmark.generate_corpus(form_class, 200, seed=1)
+        self.assertEqual(corpus, smsform_benchmark.generate_corpus(form_class, 200, seed=1))
+        results = [form_class().process_form(message) for message in corpus]
+        self.assertTrue(any(result.valid for result in results))
+        self.assertTrue(any(not result.valid for result in results))
+
+        summary = smsform_benchmark.run_benchmark(form_class(), corpus[:20])
+        self.assertEqual(sorted(summary), sorted(smsform_benchmark.STAGES))
+        self.assertEqual(summary["process_form"]["messages"], 20)
+
+    def test_compare(self):
+        baseline = {"small": {"bind_fields": {"messages_per_second": 1000.0},
+                              "process_form": {"messages_per_second": 1000.0}}}
+        current = {"small": {"bind_fields": {"messages_per_second": 950.0},
+                             "process_form": {"messages_per_second": 500.0}},
+                   "new": {"bind_fields": {"messages_per_second": 1.0}}}
+        self.assertEqual(smsform_benchmark.compare(baseline, current, threshold=0.1),
+                         [("small", "process_form", 1000.0, 500.0)])
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_instrumented_form(self):
+        events = []
+        form = PersonForm()
+        form.instrumentation = Instrumentation(sink=events.append, slowest=2)
+        form.process_form("REG fnAndre lnLesa ag12 locLusaka")
+        form.process_form("REG lnLesa ag12 locLusaka 08xxx11")
+        form.process_form("REG fnAndre lnLesa ag12 locLusaka 31feb15")
+
+        snapshot = form.instrumentation.snapshot()
+        self.assertEqual(snapshot["counters"][("PersonForm", "messages")], 3)
+        self.assertEqual(snapshot["counters"][("PersonForm", "invalid")], 2)
+        self.assertEqual(snapshot["counters"][("PersonForm", "date", "errors")], 2)
+        self.assertEqual(snapshot["errors"], {
+            "MissingRequiredFieldException": 1, "InvalidDateException": 2})
+        self.assertEqual(snapshot["latencies"][("PersonForm", "bind_fields")]["count"], 3)
+        self.assertEqual(snapshot["latencies"][("PersonForm", "first_name")]["count"], 2)
+
+        self.assertEqual(len(events), 3)
+        self.assertEqual(sorted(events[0]["timings"]), ["bind_fields", "validate_form"])
+        slowest = form.instrumentation.get_slowest()
+        self.assertEqual(len(slowest), 2)
+        self.assertTrue(slowest[0][0] >= slowest[1][0])
+
+    def test_uninstrumented_form(self):
+        self.assertIsNone(PersonForm.instrumentation)
+
+
+class DeclaredForm(SMSForm):
+    keyword = "DECL"
+
+    first_name = PrefixField(prefixes=["fn"])
+    last_name = PrefixField(prefixes=["ln"])
+    date = DateField(prefixes=["dt"], required=False)
+
+
+class ExtendedForm(DeclaredForm):
+    keyword = "EXT"
+
+    age = PrefixField(prefixes=["ag"], required=False)
+
+
+class TestFormPlan(unittest.TestCase):
+
+    def test_declared_fields(self):
+        self.assertEqual([field.name for field in DeclaredForm().get_fields()],
+                         ["first_name", "last_name", "date"])
+        self.assertEqual([field.name for field in ExtendedForm().get_fields()],
+                         ["first_name", "last_name", "date", "age"])
+
+    def test_lazy_compilation(self):
+        class LazyForm(SMSForm):
+            keyword = "LAZY"
+            first_name = PrefixField(prefixes=["fn"])
+        self.assertNotIn("_plan", LazyForm.__dict__)
+        self.assertFalse(LazyForm.first_name.frozen)
+        plan = LazyForm().get_plan()
+        self.assertIs(LazyForm.__dict__["_plan"], plan)
+        self.assertTrue(LazyForm.first_name.frozen)
+
+    def test_plan(self):
+        plan = DeclaredForm().get_plan()
+        self.assertIsInstance(plan, FormPlan)
+        self.assertEqual(plan.required, frozenset(["first_name", "last_name"]))
+        self.assertEqual(plan.verbose_names["first_name"], "First Name")
+        self.assertIs(plan.fields_by_name["date"], DeclaredForm.date)
+        self.assertEqual(plan.attribute_names, ("first_name", "last_name", "date"))
+        with self.assertRaises(AttributeError):
+            plan.fields = ()
+
+        result = ExtendedForm().process_form("EXT fnAndre lnLesa ag12 12jan15")
+        self.assertTrue(result.valid)
+        self.assertEqual(result.get("date"), datetime.date(2015, 1, 12))
+
+    def test_dump_and_load_plans(self):
+        import StringIO
+        plan_file = StringIO.StringIO()
+        dump_plans([PersonForm, DeclaredForm], plan_file)
+        plan_file.seek(0)
+        old_field = DeclaredForm.first_name
+        del DeclaredForm._plan
+
+        def compile_binder(*args, **kwargs):
+            raise AssertionError("Loading plans should not compile binders")
+        binder_init = FieldBinder.__init__
+        FieldBinder.__init__ = compile_binder
+        try:
+            plans = load_plans(plan_file)
+            self.assertIs(DeclaredForm().get_plan(), plans[1])
+            result = DeclaredForm().process_form("DECL fnAndre lnLesa 12jan15")
+        finally:
+            FieldBinder.__init__ = binder_init
+
+        self.assertIs(DeclaredForm.first_name, old_field)
+        self.assertIs(plans[1].fields_by_name["first_name"], old_field)
+        self.assertEqual(result.get("date"), datetime.date(2015, 1, 12))
+
+
+class TestMultipartReassembler(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [0]
+        self.reassembler = MultipartReassembler(
+            ttl=60, max_pending=3, max_parts_per_sender=2, clock=lambda: self.now[0])
+
+    def test_reassembly(self):
+        form = PersonForm()
+        self.assertIsNone(self.reassembler.process_part(
+            form, "+260971", 7, 2, 2, "ag12 locLusaka"))
+        self.assertIsNone(self.reassembler.process_part(
+            form, "+260972", 7, 2, 1, "REG fnJane "))
+        result = self.reassembler.process_part(
+            form, "+260971", 7, 2, 1, "REG fnAndre lnLesa ")
+        self.assertTrue(result.valid)
+        self.assertEqual(result.get("location"), "Lusaka")
+        self.assertEqual(len(self.reassembler), 1)
+        self.assertEqual(self.reassembler.add_part("+260971", 8, 1, 1, "REG"), "REG")
+
+    def test_ttl(self):
+        self.reassembler.add_part("+260971", 1, 2, 1, "REG ")
+        self.now[0] = 61
+        self.assertIsNone(self.reassembler.add_part("+260971", 1, 2, 2, "fnAndre"))
+        self.assertEqual(self.reassembler.dropped, 1)
+
+    def test_limits(self):
+        self.reassembler.add_part("a", 1, 3, 1, "one")
+        self.reassembler.add_part("a", 1, 3, 2, "two")
+        self.reassembler.add_part("a", 2, 3, 1, "three")
+        self.assertEqual(self.reassembler.pending.keys(), [("a", 2)])
+        for sender in "bcd":
+            self.reassembler.add_part(sender, 1, 2, 1, "part")
+        self.assertEqual(len(self.reassembler), 3)
+        self.assertEqual(self.reassembler.dropped, 2)
+        with self.assertRaises(ValueError):
+            self.reassembler.add_part("a", 3, 2, 3, "part")
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [0]
+        self.form = PersonForm()
+
+    def tearDown(self):
+        PersonForm.result_cache = None
+
+    def process(self, text, sender="+260971"):
+        return self.form.process_form(text, sender=sender)
+
+    def test_duplicates(self):
+        PersonForm.result_cache = ResultCache(ttl=60, clock=lambda: self.now[0])
+        first = self.process("REG fnAndre lnLesa ag12 locLusaka")
+        self.assertFalse(first.duplicate)
+        retry = self.process("REG  fnAndre lnLesa ag12   locLusaka")
+        self.assertTrue(retry.duplicate)
+        self.assertEqual(retry, first)
+        self.assertFalse(self.process("REG fnAndre lnLesa ag12 locLusaka", "+260972").duplicate)
+        self.assertFalse(self.form.process_form("REG fnAndre lnLesa ag12 locLusaka").duplicate)
+
+        self.now[0] = 61
+        self.assertFalse(self.process("REG fnAndre lnLesa ag12 locLusaka").duplicate)
+        self.assertEqual((PersonForm.result_cache.hits, PersonForm.result_cache.misses), (1, 3))
+
+    def test_memory_budget(self):
+        backend = MemoryResultBackend(max_items=2)
+        PersonForm.result_cache = ResultCache(backend)
+        for age in range(3):
+            self.process("REG fnAndre lnLesa ag{age} locLusaka".format(age=age))
+        self.assertEqual(len(backend), 2)
+        self.assertFalse(self.process("REG fnAndre lnLesa ag0 locLusaka").duplicate)
+
+        small_backend = MemoryResultBackend(max_bytes=1)
+        small_backend.set(u"key", self.form.process_form("REG lnLesa"), 100)
+        self.assertEqual(len(small_backend), 0)
+
+    def test_duplicates_do_not_share_values(self):
+        form = SurveyForm()
+        form.result_cache = ResultCache()
+        first = form.process_form("SURVEY yes", sender="+260971")
+        first.get("answer").append("zzz")
+        retry = form.process_form("SURVEY yes", sender="+260971")
+        self.assertEqual(retry.get("answer"), ["yes"])
+        retry.get("answer").append("n/a")
+        self.assertEqual(form.process_form("SURVEY yes", sender="+260971").get("answer"), ["yes"])
+
+    def test_size_estimate(self):
+        backend = MemoryResultBackend()
+        result = self.form.process_form("REG fnAndre lnLesa ag12 locLusaka")
+        backend.set(u"key", result, 100)
+        self.assertEqual(backend.size, 3 + estimate_size(result))
+        self.assertGreater(estimate_size(result), len("AndreLesa12Lusaka"))
+
+    def test_sqlite_backend(self):
+        import os
+        import tempfile
+        handle, path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(handle)
+        try:
+            PersonForm.result_cache = ResultCache(SQLiteResultBackend(path))
+            first = self.process("REG lnLesa ag12 locLusaka")
+            PersonForm.result_cache = ResultCache(SQLiteResultBackend(path))
+            retry = self.process("REG lnLesa ag12 locLusaka")
+            self.assertTrue(retry.duplicate)
+            self.assertEqual(retry.python_fields, first.python_fields)
+            self.assertIsInstance(retry.errors[0], MissingRequiredFieldException)
+        finally:
+            os.remove(path)
+
+
+class FailingForm(PersonForm):
+
+    def process_form(self, original_text, sender=None, mode="full"):
+        self.processed = getattr(self, "processed", 0) + 1
+        if self.processed == 3:
+            raise TypeError("failed")
+        return super(FailingForm, self).process_form(original_text, sender, mode)
+
+
+class TestCommandLine(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        import os
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as output:
+            output.write(content)
+        return path
+
+    def read_json(self, path):
+        import json
+        with open(path) as results:
+            return [json.loads(line) for line in results]
+
+    def test_jsonl(self):
+        import json
+        messages = ["REG fnAndre lnLesa ag12 locLusaka 12jan15", "REG lnLesa", "REG fnJane lnBanda ag3 locNdola"]
+        input_path = self.write("messages.jsonl", "\n".join(
+            json.dumps({"text": message}) for message in messages))
+        output_path = self.write("results.jsonl", "")
+        errors_path = self.write("errors.jsonl", "")
+
+        smsform_cli.main(["smstests:PersonForm", input_path, "--output", output_path,
+                          "--errors", errors_path, "--workers", "2", "--chunksize", "1", "--quiet"])
+        results = self.read_json(output_path)
+        self.assertEqual([result["index"] for result in results], [0, 2])
+        self.assertEqual(results[0]["fields"]["date"], "2015-01-12")
+        errors = self.read_json(errors_path)
+        self.assertEqual(errors[0]["index"], 1)
+        self.assertEqual(errors[0]["errors"][0]["type"], "MissingRequiredFieldException")
+
+        smsform_cli.main(["smstests:PersonForm", input_path, "--output", output_path,
+                          "--offset", "2", "--quiet"])
+        self.assertEqual([result["index"] for result in self.read_json(output_path)], [0, 2, 2])
+
+    def test_invalid_records(self):
+        input_path = self.write("messages.jsonl", "\n".join([
+            '{"text": "REG fnAndre lnLesa ag12 locLusaka"}', '{"text": "REG', '{"body": "REG"}',
+            '[1]', '{"text": 12}', '{"text": "REG fnJane lnBanda ag3 locNdola"}']))
+        output_path = self.write("results.jsonl", "")
+        errors_path = self.write("errors.jsonl", "")
+        smsform_cli.main(["smstests:PersonForm", input_path, "--output", output_path,
+                          "--errors", errors_path, "--workers", "2", "--chunksize", "2",
+                          "--quiet"])
+        self.assertEqual([result["index"] for result in self.read_json(output_path)], [0, 5])
+        errors = self.read_json(errors_path)
+        self.assertEqual([error["index"] for error in errors], [1, 2, 3, 4])
+        self.assertEqual(set(error["errors"][0]["type"] for error in errors), set(["InvalidRecord"]))
+
+    def test_offset_on_failure(self):
+        import StringIO
+        input_path = self.write("messages.jsonl", "\n".join(
+            '{"text": "REG lnLesa"}' for _ in range(3)))
+        output_path = self.write("results.jsonl", "")
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            with self.assertRaises(TypeError):
+                smsform_cli.main(["smstests:FailingForm", input_path, "--output", output_path,
+                                  "--quiet"])
+            report = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertIn("--offset 2", report)
+
+    def test_csv(self):
+        input_path = self.write("messages.csv", "id,message\n1,REG fnAndre lnLesa ag12 locLusaka\n")
+        output_path = self.write("results.jsonl", "")
+        smsform_cli.main(["smstests.PersonForm", input_path, "--output", output_path,
+                          "--text-field", "message", "--quiet"])
+        self.assertEqual(self.read_json(output_path)[0]["fields"]["first_name"], "Andre")
+
+
+class TestBulkSink(unittest.TestCase):
+
+    def setUp(self):
+        import sqlite3
+        self.connection = sqlite3.connect(":memory:", check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE people (first_name TEXT, last_name TEXT, age TEXT, date DATE)")
+        self.connection.execute("CREATE TABLE rejected (text TEXT, errors TEXT)")
+        self.form = PersonForm()
+        self.texts = ["REG fnAndre lnLesa ag{age} locLusaka 12jan15".format(age=age)
+                      for age in range(7)] + ["REG lnLesa"]
+
+    def count(self, table):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM {table}".format(table=table)).fetchone()[0]
+
+    def test_batches(self):
+        now = [0]
+        sink = BulkSink(self.connection, "people", ["first_name", "last_name", "age", "date"],
+                        error_table="rejected", batch_size=3, flush_interval=10,
+                        clock=lambda: now[0])
+        for text in self.texts[:2]:
+            sink.add(self.form.process_form(text), text)
+        self.assertEqual(self.count("people"), 0)
+        now[0] = 10
+        sink.add(self.form.process_form(self.texts[-1]), self.texts[-1])
+        self.assertEqual((self.count("people"), self.count("rejected")), (2, 1))
+        for text in self.texts[2:7]:
+            sink.add(self.form.process_form(text), text)
+        self.assertEqual(self.count("people"), 5)
+        sink.close()
+        self.assertEqual(self.count("people"), 7)
+        self.assertEqual(self.connection.execute(
+            "SELECT first_name, age, date FROM people WHERE age = '6'").fetchone(),
+            (u"Andre", u"6", u"2015-01-12"))
+        self.assertIn("first_name", self.connection.execute(
+            "SELECT errors FROM rejected").fetchone()[0])
+
+    def test_threaded(self):
+        sink = BulkSink(self.connection, "people", ["first_name", "age"], batch_size=2,
+                        threaded=True, max_queue=2)
+        for text in self.texts * 3:
+            sink.add(self.form.process_form(text), text)
+        sink.close()
+        self.assertEqual((sink.written, sink.errors_written), (21, 0))
+        self.assertEqual(self.count("people"), 21)
+
+    def test_number_values(self):
+        self.connection.execute("CREATE TABLE stock (facility TEXT, packs INTEGER, weight NUMERIC)")
+        sink = BulkSink(self.connection, "stock", ["facility", "packs", "weight"])
+        sink.add(StockForm().process_form("STOCK fLusaka p12 w1.5kg"))
+        sink.close()
+        self.assertEqual(self.connection.execute("SELECT * FROM stock").fetchone(),
+                         (u"Lusaka", 12, 1500))
+
+
+class PositionalPersonForm(SMSForm):
+    keyword = "REG"
+    binding = "positional"
+    blank_field = "_"
+
+    first_name = PrefixField()
+    last_name = PrefixField()
+    age = PrefixField()
+    location = PrefixField()
+    ward = PrefixField(required=False)
+    date = DateField(required=False)
+
+
+class HybridPersonForm(PositionalPersonForm):
+    binding = "hybrid"
+
+    first_name = PrefixField(prefixes=["fn"])
+    date = DateField(prefixes=["dt"], required=False)
+
+
+class TestPositionalBinding(unittest.TestCase):
+
+    def test_positional(self):
+        result = PositionalPersonForm().process_form("REG Andre Lesa 12 Lusaka _ 12jan15")
+        self.assertTrue(result.valid)
+        self.assertEqual(result.to_dict(), {
+            "first_name": "Andre", "last_name": "Lesa", "age": "12",
+            "location": "Lusaka", "date": datetime.date(2015, 1, 12)})
+
+    def test_positional_missing_field(self):
+        result = PositionalPersonForm().process_form("REG Andre Lesa _ Lusaka")
+        self.assertFalse(result.valid)
+        self.assertIsInstance(result.errors[0], MissingRequiredFieldException)
+
+    def test_hybrid(self):
+        form = HybridPersonForm()
+        self.assertEqual([field.name for field in form.get_fields()], [
+            "first_name", "last_name", "age", "location", "ward", "date"])
+        result = form.process_form("REG dt12jan15 Lesa 12 fnAndre Lusaka _")
+        self.assertTrue(result.valid)
+        self.assertEqual(result.get("first_name"), "Andre")
+        self.assertEqual(result.get_prefix("first_name"), "fn")
+        self.assertEqual(result.get("location"), "Lusaka")
+        self.assertNotIn("ward", result)
+
+    def test_unknown_binding(self):
+        with self.assertRaises(ValueError):
+            FieldBinder([], binding="keyword")
+
+
+class StockForm(SMSForm):
+    keyword = "STOCK"
+
+    facility = PrefixField(prefixes=["f"])
+    packs = IntegerField(prefixes=["p"], min_value=0, max_value=1000)
+    weight = DecimalField(prefixes=["w"], units={"kg": 1000, "g": 1}, required=False)
+
+
+class TestNumberFields(unittest.TestCase):
+
+    def test_form(self):
+        result = StockForm().process_form("STOCK fLusaka p12 w1.5kg")
+        self.assertTrue(result.valid)
+        self.assertEqual(result.get("packs"), 12)
+        self.assertEqual(result.get("weight"), decimal.Decimal("1500.0"))
+
+        valid, python_fields, errors = StockForm().process_form("STOCK fLusaka p1200 w3lb")
+        self.assertFalse(valid)
+        self.assertIsInstance(errors[0], NumberRangeException)
+        self.assertIsInstance(errors[1], InvalidNumberException)
+
+    def test_to_python(self):
+        field = IntegerField(name="age", units=["yrs"])
+        self.assertEqual(field.to_python("-3yrs"), (-3, ""))
+        self.assertEqual(field.to_python(""), (None, ""))
+        with self.assertRaises(InvalidNumberException):
+            field.to_python("twelve")
+        with self.assertRaises(MissingRequiredFieldException):
+            field.process_field("")
+
+    def test_unit_multipliers(self):
+        with self.assertRaises(ValueError):
+            IntegerField(name="weight", units={"k": 0.5})
+        with self.assertRaises(ValueError):
+            DecimalField(name="weight", units={"k": "half"})
+        field = DecimalField(name="weight", units={"k": 0.5})
+        self.assertEqual(field.process_field("3k"), decimal.Decimal("1.5"))
+
+    def check_column(self, field):
+        values = field.process_column(["5", "12", "-1", "x", "1dz"])
+        self.assertEqual(values[:2], [5, 12])
+        self.assertIsInstance(values[2], NumberRangeException)
+        self.assertIsInstance(values[3], InvalidNumberException)
+        self.assertEqual(values[4], 12)
+
+        self.assertEqual(field.process_column(["5", "12"]), [5, 12])
+        values = field.process_column(["5", "12", "13"])
+        self.assertEqual(values[:2], [5, 12])
+        self.assertIsInstance(values[2], NumberRangeException)
+
+    def test_column_without_numpy(self):
+        numpy = smsform_fields.numpy
+        smsform_fields.numpy = None
+        try:
+            self.check_column(IntegerField(name="count", min_value=0, max_value=12,
+                                           units={"dz": 12}))
+        finally:
+            smsform_fields.numpy = numpy
+
+    @unittest.skipIf(smsform_fields.numpy is None, "numpy is not installed")
+    def test_column_with_numpy(self):
+        self.check_column(IntegerField(name="count", min_value=0, max_value=12,
+                                       units={"dz": 12}))
+        field = DecimalField(name="weight", max_value=2)
+        self.assertEqual(field.process_column(["1.5", ".5"]),
+                         [decimal.Decimal("1.5"), decimal.Decimal(".5")])
+        self.assertIsInstance(field.process_column(["1e1"])[0], InvalidNumberException)
+
+    @unittest.skipIf(smsform_fields.numpy is None, "numpy is not installed")
+    def test_column_matches_process_field(self):
+        def even_validator(value, **kwargs):
+            if value % 2:
+                raise InvalidNumberException("{value} is odd".format(value=value))
+
+        def describe(value):
+            if isinstance(value, Exception):
+                return type(value), str(value)
+            return value
+
+        fields = [IntegerField(name="count", min_value=0, max_value=12),
+                  IntegerField(name="count", validators=[even_validator]),
+                  DecimalField(name="weight", max_value=2)]
+        columns = [["5", "12", "007", "-1", "13"], ["+5", "6"], [" 5", "6"], ["5", ""],
+                   ["2", "4", "5"], ["1.5", "2.0000000000000000001"]]
+        for field in fields:
+            for column in columns:
+                self.assertEqual(
+                    [describe(value) for value in field.process_column(column)],
+                    [describe(field.process_value(text)) for text in column])
+
+
+class TestValidationModes(unittest.TestCase):
+
+    def setUp(self):
+        self.form = PersonForm()
+
+    def test_fail_fast(self):
+        text = "REG fnAndre ag12 dtbad"
+        self.assertEqual(len(self.form.process_form(text).errors), 3)
+        result = self.form.process_form(text, mode="fail_fast")
+        self.assertFalse(result.valid)
+        self.assertEqual([str(error) for error in result.errors],
+                         [str(MissingRequiredFieldException("last_name"))])
+
+    def test_errors_only(self):
+        result = self.form.process_form("REG fnAndre lnLesa ag12 locLusaka", mode="errors_only")
+        self.assertTrue(result.valid)
+        self.assertEqual(result.python_fields, ())
+        result = self.form.process_form("REG fnAndre lnLesa ag12 locLusaka dtbad",
+                                        mode="errors_only")
+        self.assertFalse(result.valid)
+        self.assertIsInstance(result.errors[0], InvalidDateException)
+
+    def test_errors_only_skips_conversion(self):
+        form = SurveyForm()
+        memo = SurveyForm.answer.memo
+        lookups = memo.hits + memo.misses
+        result = form.process_form("SURVEY yes", mode="errors_only")
+        self.assertTrue(result.valid)
+        self.assertEqual(memo.hits + memo.misses, lookups)
+        self.assertTrue(SurveyForm.answer.check_field("YES") is None)
+
+        full = form.process_form("SURVEY yes,n/a", mode="full")
+        checked = form.process_form("SURVEY yes,n/a", mode="errors_only")
+        self.assertFalse(checked.valid)
+        self.assertEqual([str(error) for error in checked.errors],
+                         [str(error) for error in full.errors])
+
+    def test_lazy(self):
+        result = self.form.process_form("REG fnAndre lnLesa ag12 locLusaka dt12/jan/15",
+                                        mode="lazy")
+        self.assertIsNone(result.valid)
+        self.assertIsInstance(result.values[4], LazyValue)
+        self.assertFalse(result.values[4].converted)
+        self.assertEqual(result.get("date"), datetime.date(2015, 1, 12))
+        self.assertTrue(result.values[4].converted)
+
+        result = self.form.process_form("REG fnAndre lnLesa ag12 locLusaka dtbad", mode="lazy")
+        self.assertIsNone(result.valid)
+        with self.assertRaises(InvalidDateException):
+            result.get("date")
+        self.assertFalse(self.form.process_form("REG fnAndre", mode="lazy").valid)
+
+    def test_lazy_validate(self):
+        import sqlite3
+        connection = sqlite3.connect(":memory:")
+        connection.execute("CREATE TABLE people (first_name TEXT)")
+        sink = BulkSink(connection, "people", ["first_name"], batch_size=10)
+        result = self.form.process_form("REG fnAndre lnLesa ag12 locLusaka dtbad", mode="lazy")
+        with self.assertRaises(ValueError):
+            sink.add(result)
+
+        self.assertIs(result.validate(), result)
+        self.assertFalse(result.valid)
+        self.assertIsInstance(result.errors[0], InvalidDateException)
+        result = self.form.process_form("REG fnAndre lnLesa ag12 locLusaka dt12/jan/15",
+                                        mode="lazy").validate()
+        self.assertTrue(result.valid)
+        self.assertEqual(result.values[4], datetime.date(2015, 1, 12))
+        sink.add(result)
+        sink.flush()
+        self.assertEqual(sink.written, 1)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            self.form.process_form("REG fnAndre", mode="quick")
+
+
+class TestSessionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [0]
+        self.form = PersonForm()
+        self.form.session_store = SessionStore(ttl=60, clock=lambda: self.now[0])
+
+    def process(self, text, sender="+260971"):
+        return self.form.process_form(text, sender=sender)
+
+    def test_follow_up(self):
+        result = self.process("REG fnAndre lnLesa ag12 dtbad")
+        self.assertFalse(result.valid)
+        self.assertFalse(self.process("ag13").valid)
+        result = self.process("fnJohn locLusaka dt12/jan/15")
+        self.assertTrue(result.valid)
+        self.assertEqual(result.get("first_name"), "Andre")
+        self.assertEqual(result.get("age"), "12")
+        self.assertEqual(result.get("date"), datetime.date(2015, 1, 12))
+        self.assertEqual(self.form.session_store.continued, 2)
+        # The session is closed once the form is valid
+        self.assertFalse(self.process("locLusaka").valid)
+
+    def test_new_message_and_expiry(self):
+        self.process("REG fnAndre lnLesa ag12")
+        self.assertFalse(self.process("REG fnJohn locLusaka").valid)
+        self.assertFalse(self.process("lnLesa ag12", sender="+260972").valid)
+        self.now[0] = 61
+        self.assertFalse(self.process("lnBanda ag30").valid)
+        self.assertEqual(self.form.session_store.continued, 0)
+
+    def test_size_cap(self):
+        self.form.session_store = SessionStore(max_session_size=10)
+        self.process("REG fnAndre lnLesa ag12")
+        self.assertFalse(self.process("locLusaka").valid)
+
+    def test_positional_follow_up(self):
+        form = PositionalPersonForm()
+        form.session_store = SessionStore()
+        self.assertFalse(form.process_form("REG Andre Lesa", sender="+260971").valid)
+        result = form.process_form("12 Lusaka", sender="+260971")
+        self.assertTrue(result.valid)
+        self.assertEqual(result.get("location"), "Lusaka")
+
+    def test_result_cache(self):
+        self.form.result_cache = ResultCache()
+        self.process("REG fnAndre ag12 locLusaka")
+        result = self.process("lnLesa")
+        self.assertTrue(result.valid)
+        self.assertEqual(result.get("first_name"), "Andre")
+        self.process("REG fnBob ag20 locNdola")
+        result = self.process("lnLesa")
+        self.assertTrue(result.valid)
+        self.assertFalse(result.duplicate)
+        self.assertEqual(result.get("first_name"), "Bob")
+        # Messages that start a session are still answered from the cache
+        self.assertTrue(self.process("REG fnBob ag20 locNdola").duplicate)
+
+    def test_sqlite_backend(self):
+        self.form.session_store = SessionStore(SQLiteResultBackend(":memory:"))
+        self.process("REG fnAndre lnLesa ag12")
+        self.assertTrue(self.process("locLusaka").valid)
+
+
+class SurveyForm(SMSForm):
+    keyword = "SURVEY"
+
+    answer = SingleChoiceField(choices=["n/a", "a.b", "yes"])
+    date = DateField(required=False)
+
+
+def slow_validator(value, **kwargs):
+    time.sleep(0.02)
+
+
+class SlowForm(SMSForm):
+    keyword = "SLOW"
+    time_budget = 0.01
+
+    first_name = PrefixField(prefixes=["fn"], validators=[slow_validator])
+    last_name = PrefixField(prefixes=["ln"])
+
+
+class TestMessageBudgets(unittest.TestCase):
+
+    def test_escaped_choices(self):
+        self.assertTrue(SurveyForm().process_form("SURVEY a.b").valid)
+        self.assertTrue(SurveyForm().process_form("SURVEY n/a").valid)
+        self.assertFalse(SurveyForm().process_form("SURVEY axb").valid)
+        self.assertFalse(SurveyForm().process_form("SURVEY yesterday").valid)
+        self.assertFalse(SurveyForm().process_form("SURVEY ayes").valid)
+        self.assertEqual(SurveyForm().process_form("SURVEY YES").get("answer"), ["YES"])
+        field = PrefixField(prefixes=["a+"], name="amount")
+        self.assertEqual(field.get_field_regex()[0]["regex"], r"\ba\+(?P<amount>\w*)")
+
+    def test_too_long(self):
+        text = "SURVEY " + "1" * 1600
+        result = SurveyForm().process_form(text)
+        self.assertFalse(result.valid)
+        self.assertIsInstance(result.errors[0], MessageTooLongException)
+        self.assertEqual(str(result.errors[0]), "The message is longer than 1600 characters.")
+
+    def test_hostile_message(self):
+        start = time.time()
+        for text in ["SURVEY " + "1" * 1500 + "x", "SURVEY " + "a." * 790, "SURVEY " + "9/" * 790]:
+            self.assertFalse(SurveyForm().process_form(text).valid)
+        self.assertLess(time.time() - start, 1)
+
+    def test_time_budget(self):
+        result = SlowForm().process_form("SLOW fnAndre lnLesa")
+        self.assertFalse(result.valid)
+        self.assertIsInstance(result.errors[-1], MessageTimeoutException)
+        self.assertNotIn("last_name", result)
+
+
+class TestFieldMemo(unittest.TestCase):
+
+    def test_pure_fields(self):
+        field = DateField(name="date")
+        self.assertEqual(field.process_field("12jan15"), datetime.date(2015, 1, 12))
+        self.assertEqual(field.process_field("12jan15"), datetime.date(2015, 1, 12))
+        for _ in range(2):
+            with self.assertRaises(InvalidDateException):
+                field.process_field("12xyz15")
+        self.assertEqual((field.memo.hits, field.memo.misses), (2, 2))
+        self.assertIsNone(DateField(name="date", memo_size=0).memo)
+        self.assertIsNone(field.date_parser.cache)
+        self.assertEqual(DateField(name="date", cache_size=10).memo.max_size, 10)
+
+    def test_opt_in(self):
+        self.assertIsNone(PrefixField(name="location").memo)
+        field = PrefixField(name="location", memo_size=2)
+        for location in ["Lusaka", "Ndola", "Lusaka", "Kitwe", "Ndola"]:
+            self.assertEqual(field.process_field(location), location)
+        self.assertEqual((field.memo.hits, field.memo.misses), (1, 4))
+
+    def test_values_are_copied(self):
+        field = MultiChoiceField(choices=["a", "b"], name="answers")
+        field.process_field("a,b").append("c")
+        self.assertEqual(field.process_field("a,b"), ["a", "b"])
+
+    def test_shared_by_threads(self):
+        field = SingleChoiceField(choices=["yes", "no"], name="answer")
+        pool = multiprocessing.pool.ThreadPool(4)
+        try:
+            values = pool.map(field.process_field, ["yes", "no"] * 500)
+        finally:
+            pool.close()
+        self.assertEqual(values, [["yes"], ["no"]] * 500)
+        self.assertEqual(field.memo.hits + field.memo.misses, 1000)
+
+
+SCHEMA = {"forms": [
+    {"name": "SchemaPersonForm", "keyword": "REG", "aliases": ["register"],
+     "fields": [{"name": "first_name", "prefixes": ["fn"]},
+                {"name": "gender", "type": "single_choice", "choices": ["m", "f"]},
+                {"name": "date", "type": "date", "prefixes": ["dt"], "required": False}]},
+    {"name": "SchemaStockForm", "keyword": "STOCK",
+     "fields": [{"name": "packs", "type": "integer", "prefixes": ["p"], "min_value": 0}]},
+]}
+
+
+class TestSchemaLoader(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.path = self.write(SCHEMA)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def write(self, schema, mtime=1000):
+        import json
+        import os
+        path = os.path.join(self.directory, "forms.json")
+        with open(path, "w") as output:
+            json.dump(schema, output)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_build(self):
+        loader = SchemaLoader(self.path)
+        form, result = loader.dispatch("register fnAndre f dt12/jan/15")
+        self.assertEqual(type(form).__name__, "SchemaPersonForm")
+        self.assertTrue(result.valid)
+        self.assertEqual(result.to_dict(), {
+            "first_name": "Andre", "gender": ["f"], "date": datetime.date(2015, 1, 12)})
+        self.assertFalse(loader.dispatch("STOCK p-1")[1].valid)
+
+    def test_incremental_reload(self):
+        reloads = []
+        loader = SchemaLoader(self.path, on_reload=lambda loader, rebuilt, latency:
+                              reloads.append(rebuilt))
+        old_form = loader.route("REG fnAndre m")
+        stock_form_class = loader.form_classes["SchemaStockForm"]
+        self.assertEqual(loader.check(), [])
+
+        schema = {"forms": [dict(SCHEMA["forms"][0], fields=SCHEMA["forms"][0]["fields"] + [
+            {"name": "age", "type": "integer", "prefixes": ["ag"]}]), SCHEMA["forms"][1]]}
+        self.write(schema, mtime=2000)
+        self.assertEqual(loader.check(), ["SchemaPersonForm"])
+        self.assertEqual(reloads, [["SchemaPersonForm", "SchemaStockForm"], ["SchemaPersonForm"]])
+        self.assertIs(loader.form_classes["SchemaStockForm"], stock_form_class)
+        self.assertGreaterEqual(loader.last_swap_latency, 0)
+
+        # A message routed before the swap finishes on the old form
+        self.assertTrue(old_form.process_form("REG fnAndre m").valid)
+        self.assertFalse(loader.dispatch("REG fnAndre m")[1].valid)
+        self.assertEqual(loader.dispatch("REG fnAndre m ag30")[1].get("age"), 30)
+
+    def test_required_fields(self):
+        schema = {"forms": [{"name": "SchemaVisitForm", "keyword": "VISIT", "fields": [
+            {"name": "first_name", "prefixes": ["fn"], "required": True},
+            {"name": "age", "type": "integer", "prefixes": ["ag"], "required": False}]}]}
+        loader = SchemaLoader(self.write(schema))
+        self.assertTrue(loader.form_classes["SchemaVisitForm"].first_name.required)
+        result = loader.dispatch("VISIT ag12")[1]
+        self.assertFalse(result.valid)
+        self.assertIsInstance(result.errors[0], MissingRequiredFieldException)
+        self.assertTrue(loader.dispatch("VISIT fnAndre")[1].valid)
+
+    def test_session_follow_up(self):
+        class SessionForm(SMSForm):
+            session_store = SessionStore()
+
+        loader = SchemaLoader(self.path, base_class=SessionForm)
+        self.assertFalse(loader.dispatch("REG fnAndre", sender="+260971")[1].valid)
+        form, result = loader.dispatch("m", sender="+260971")
+        self.assertTrue(result.valid)
+        self.assertEqual(result.get("first_name"), "Andre")
+
+    def test_bad_schema(self):
+        loader = SchemaLoader(self.path)
+        self.write({"forms": [{"name": "BadForm", "keyword": "BAD",
+                               "fields": [{"name": "x", "type": "colour"}]}]}, mtime=2000)
+        with self.assertRaises(ValueError):
+            loader.check()
+        self.assertTrue(loader.dispatch("REG fnAndre m")[1].valid)
+
+    def test_bad_field_options(self):
+        loader = SchemaLoader(self.path)
+        for field in [{"name": "first_name", "prefixes": ["fn"], "requird": False},
+                      {"name": "first_name", "prefixes": "fn"},
+                      {"name": "first_name", "choices": ["a", "b"]},
+                      {"name": "answer", "type": "single_choice", "choices": "yn"},
+                      {"name": "count", "type": "integer", "units": "dz"}]:
+            self.write({"forms": [{"name": "BadForm", "keyword": "BAD", "fields": [field]}]},
+                       mtime=2000)
+            with self.assertRaises(ValueError):
+                loader.reload()
+        self.assertEqual(sorted(loader.form_classes), ["SchemaPersonForm", "SchemaStockForm"])
+
+    def test_watch(self):
+        loader = SchemaLoader(self.path)
+        loader.watch(poll_interval=0.01)
+        try:
+            self.write({"forms": [SCHEMA["forms"][1]]}, mtime=2000)
+            for _ in range(500):
+                if "SchemaPersonForm" not in loader.form_classes:
+                    break
+                time.sleep(0.01)
+        finally:
+            loader.stop()
+        self.assertEqual(list(loader.form_classes), ["SchemaStockForm"])
+        with self.assertRaises(UnknownKeywordException):
+            loader.route("REG fnAndre m")
+
+
 class TestSMSFields(unittest.TestCase):
 
     def setUp(self):
@@ -141,6 +1322,55 @@ class TestSMSFields(unittest.TestCase):
 
         self.assertEqual(python_date, (datetime.date(2014, 11, 8), ""))
 
+    def test_numeric_date_to_python(self):
+        field = DateField(name="date")
+        self.assertEqual(field.to_python("08/11/2014")[0], datetime.date(2014, 11, 8))
+        self.assertEqual(field.to_python("8-11-14")[0], datetime.date(2014, 11, 8))
+        with self.assertRaises(InvalidDateException):
+            field.to_python("31/02/2014")
+
+    def test_date_parser_matches_strptime(self):
+        date_formats = ["%d/%b/%y", "%d%b%y", "%d/%m/%Y", "%Y-%m-%d", "%d %B %Y"]
+        parser = DateParser(date_formats, cache_size=0)
+        for date_string in ["08/nov/14", "8NOV70", "12jan15", "29feb16", "29feb15",
+                            "1/1/1999", "2015-01-12", "3 March 2001", "32jan15", "12jan"]:
+            expected = None
+            for date_format in date_formats:
+                try:
+                    expected = datetime.datetime.strptime(date_string, date_format).date()
+                    break
+                except ValueError:
+                    continue
+            self.assertEqual(parser.parse(date_string), expected, date_string)
+
+    def test_date_parser_reorders_formats(self):
+        parser = DateParser(["%d/%b/%y", "%d%b%y"])
+        parser.parse("12jan15")
+        parser.parse("13jan15")
+        self.assertEqual([date_format.date_format for date_format in parser.formats],
+                         ["%d%b%y", "%d/%b/%y"])
+        parser.parse("12JAN15")
+        self.assertEqual((parser.cache.hits, len(parser.cache)), (1, 2))
+
+    def test_date_parser_keeps_overlapping_formats(self):
+        parser = DateParser(["%d/%m/%Y", "%m/%d/%Y", "%d%b%y"], cache_size=0)
+        self.assertEqual(parser.parse("01/02/2015"), datetime.date(2015, 2, 1))
+        for _ in range(3):
+            self.assertEqual(parser.parse("12/25/2015"), datetime.date(2015, 12, 25))
+        for _ in range(5):
+            parser.parse("12jan15")
+        self.assertEqual(parser.parse("01/02/2015"), datetime.date(2015, 2, 1))
+        self.assertEqual([date_format.date_format for date_format in parser.formats],
+                         ["%d%b%y", "%d/%m/%Y", "%m/%d/%Y"])
+
+    def test_frozen_field(self):
+        field = PrefixField(prefixes=["fn"], name="first_name")
+        field.required = False
+        FieldBinder([field])
+        with self.assertRaises(AttributeError):
+            field.required = True
+        self.assertEqual(field.process_field("andre", "fn"), "andre")
+
     def test_for_required_field(self):
         field = PrefixField(prefixes=["fn"], name="first_name")
 
@@ -185,6 +1415,48 @@ class TestSMSFields(unittest.TestCase):
         with self.assertRaises(ChoiceException):
             field.validate(["attorney", "ceo"])
 
+    def test_choice_index(self):
+        field = SingleChoiceField(
+            choices=["Clerk", "Officer"], name="position")
+        self.assertEqual(field.choice_index, frozenset(["clerk", "officer"]))
+        self.assertTrue(field.validate(["OFFICER"]))
+        with self.assertRaises(ChoiceException):
+            field.validate(["clerk", "officer"])
+
+    def test_fuzzy_choice_correction(self):
+        field = SingleChoiceField(
+            choices=self.POSITION_CHOICES, name="position", fuzzy=True)
+        self.assertEqual(field.process_field("offcer"), ["officer"])
+        self.assertEqual(field.process_field("Clerk"), ["Clerk"])
+        with self.assertRaises(ChoiceException):
+            field.process_field("ceo")
+
+    def test_fuzzy_choice_binding(self):
+        class StaffForm(SMSForm):
+            keyword = "STAFF"
+            position = MultiChoiceField(
+                choices=self.POSITION_CHOICES, prefixes=["pos"], name="position",
+                fuzzy=True, max_distance=2)
+
+            def get_fields(self):
+                return [self.position]
+
+        valid, python_fields, errors = StaffForm().process_form("STAFF posofcer,drector")
+        self.assertTrue(valid)
+        self.assertEqual(python_fields, (("position", ("pos", ["officer", "director"])),))
+
+    def test_fuzzy_choice_binding_without_prefix(self):
+        class StaffForm(SMSForm):
+            keyword = "STAFF"
+            first_name = PrefixField(prefixes=["fn"])
+            position = SingleChoiceField(choices=self.POSITION_CHOICES, fuzzy=True)
+
+        result = StaffForm().process_form("STAFF fnAndre offcer")
+        self.assertTrue(result.valid)
+        self.assertEqual(result.get("position"), ["officer"])
+        result = StaffForm().process_form("STAFF fnAndre ceo")
+        self.assertIsInstance(result.errors[0], MissingRequiredFieldException)
+
     def test_to_python(self):
         field = DateField(name="date_field")
 